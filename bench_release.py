@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+# Benchmarks release.py against generated repositories of increasing size.
+#
+# Each repository is generated once per size with git fast-import and copied
+# for every benchmark, so a benchmark always starts from the same state.
+# cargo is replaced by a stub build command and origin is a local bare
+# repository, so no network or Rust toolchain is needed.
+
+import __builtin__
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from os import sys
+
+import release
+
+STUB_BUILD_CMD = 'true'
+PACKAGE_NAME = 'vors'
+STARTING_VERSION = '1.0.0-SNAPSHOT'
+
+# The shape of the generated repositories.
+SIZES = {
+    'tiny': {'files': 10, 'commits': 5, 'tags': 2, 'branches': 2, 'readme_lines': 10, 'dependencies': 5},
+    'small': {'files': 1000, 'commits': 100, 'tags': 50, 'branches': 50, 'readme_lines': 1000, 'dependencies': 50},
+    'medium': {'files': 10000, 'commits': 1000, 'tags': 500, 'branches': 500, 'readme_lines': 20000, 'dependencies': 200},
+    'large': {'files': 50000, 'commits': 5000, 'tags': 2000, 'branches': 2000, 'readme_lines': 200000, 'dependencies': 1000},
+}
+DEFAULT_SIZES = 'tiny,small,medium'
+# A benchmark more than this many times slower than its baseline is reported
+# as a regression.
+DEFAULT_REGRESSION_THRESHOLD = 1.25
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='Comma separated repository sizes to benchmark: [ {} ]. Default = {}'.format(' | '.join(sorted(SIZES)), DEFAULT_SIZES))
+    parser.add_argument('--benchmarks', help='Comma separated benchmarks to run. Default = all')
+    parser.add_argument('--repeat', type=int, default=3, help='Run each benchmark this many times and keep the fastest. Default = 3')
+    parser.add_argument('--output', default='bench_output.json', help='The file the results are written to. Default = ./bench_output.json')
+    parser.add_argument('--baseline', help='A previous --output file to compare the results against.')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD, help='The slowdown relative to the baseline reported as a regression. Default = {}'.format(DEFAULT_REGRESSION_THRESHOLD))
+    args = parser.parse_args()
+
+    benchmark_names = args.benchmarks.split(',') if args.benchmarks else [name for name, _ in BENCHMARKS]
+    unknown = set(benchmark_names) - set(name for name, _ in BENCHMARKS)
+    if unknown:
+        print 'Unknown benchmarks: {}'.format(', '.join(sorted(unknown)))
+        sys.exit(1)
+
+    results = run_benchmarks(args.sizes.split(','), benchmark_names, args.repeat)
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+    print 'Wrote results to {}.'.format(args.output)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_results(results, baseline, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+def run_benchmarks(sizes, benchmark_names, repeat):
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix='vors-bench-')
+    try:
+        for size in sizes:
+            template_dir = os.path.join(work_dir, size)
+            print 'Generating the {} repository.'.format(size)
+            generate_repository(template_dir, SIZES[size])
+            results[size] = {}
+            for name, benchmark in BENCHMARKS:
+                if name not in benchmark_names:
+                    continue
+                timings = []
+                for _ in range(repeat):
+                    timings.append(run_benchmark(benchmark, template_dir, os.path.join(work_dir, 'run')))
+                results[size][name] = min(timings)
+                print '{:>8} {:<28} {:10.4f}s'.format(size, name, results[size][name])
+    finally:
+        shutil.rmtree(work_dir)
+    return results
+
+def run_benchmark(benchmark, template_dir, run_dir):
+    # Every run gets its own copy of the repository and its origin.
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    shutil.copytree(template_dir, run_dir, symlinks=True)
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    os.chdir(os.path.join(run_dir, 'work'))
+    # The release prints progress which would drown out the results.
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return benchmark()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.chdir(cwd)
+
+def compare_results(results, baseline, threshold):
+    regressions = []
+    print '{:>8} {:<28} {:>10} {:>10} {:>7}'.format('size', 'benchmark', 'baseline', 'current', 'ratio')
+    for size in sorted(results):
+        for name in sorted(results[size]):
+            previous = baseline.get(size, {}).get(name)
+            if previous is None:
+                continue
+            current = results[size][name]
+            ratio = current / previous if previous else float('inf')
+            flag = ''
+            if ratio > threshold:
+                regressions.append((size, name, ratio))
+                flag = ' REGRESSION'
+            print '{:>8} {:<28} {:10.4f} {:10.4f} {:7.2f}{}'.format(size, name, previous, current, ratio, flag)
+    return regressions
+
+def generate_repository(path, size):
+    # Writes path/origin.git, a bare repository, and path/work, a clone of it
+    # on the develop branch.
+    os.makedirs(path)
+    origin_dir = os.path.join(path, 'origin.git')
+    work_dir = os.path.join(path, 'work')
+    git(path, 'init', '-q', '--bare', origin_dir)
+
+    git(path, 'init', '-q', work_dir)
+    git(work_dir, 'config', 'user.email', 'bench@example.com')
+    git(work_dir, 'config', 'user.name', 'Bench')
+    fast_import = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=work_dir, stdin=subprocess.PIPE)
+    write_history(fast_import.stdin, size)
+    fast_import.stdin.close()
+    if fast_import.wait() != 0:
+        raise RuntimeError('git fast-import failed')
+
+    git(work_dir, 'checkout', '-q', '-f', release.BRANCH_DEVELOP)
+    git(work_dir, 'remote', 'add', 'origin', origin_dir)
+    git(work_dir, 'push', '-q', 'origin', 'refs/heads/*:refs/heads/*', '--tags')
+
+def write_history(stream, size):
+    mark = [0]
+    def next_mark():
+        mark[0] += 1
+        return mark[0]
+
+    def write_data(content):
+        stream.write('data {}\n{}\n'.format(len(content), content))
+
+    def write_commit(branch, message, files, parent=None):
+        commit_mark = next_mark()
+        stream.write('commit refs/heads/{}\nmark :{}\n'.format(branch, commit_mark))
+        stream.write('committer Bench <bench@example.com> 1500000000 +0000\n')
+        write_data(message)
+        if parent is not None:
+            stream.write('from :{}\n'.format(parent))
+        for file_path, content in files:
+            stream.write('M 100644 inline {}\n'.format(file_path))
+            write_data(content)
+        return commit_mark
+
+    initial_files = [
+        ('Cargo.toml', cargo_content(size['dependencies'])),
+        ('README.md', readme_content(size['readme_lines'])),
+        ('src/version.txt', STARTING_VERSION),
+        ('src/main.rs', 'fn main() {}\n'),
+    ]
+    for index in range(size['files']):
+        initial_files.append(('src/module{}/file{}.rs'.format(index % 100, index), '// file {}\n'.format(index)))
+    head = write_commit(release.BRANCH_MASTER, 'Initial commit.', initial_files)
+    stream.write('reset refs/heads/{}\nfrom :{}\n\n'.format(release.BRANCH_TEST_MASTER, head))
+
+    for index in range(size['commits']):
+        head = write_commit(
+            release.BRANCH_DEVELOP,
+            'Change {}.'.format(index),
+            [('src/module{}/file{}.rs'.format(index % 100, index % size['files']), '// change {}\n'.format(index))],
+            parent=head
+        )
+        if index < size['tags']:
+            stream.write('tag v0.{}.0\nfrom :{}\ntagger Bench <bench@example.com> 1500000000 +0000\n'.format(index, head))
+            write_data('v0.{}.0'.format(index))
+
+    for index in range(size['branches']):
+        stream.write('reset refs/heads/feature/{}\nfrom :{}\n\n'.format(index, head))
+
+def cargo_content(dependencies):
+    lines = [
+        '[package]',
+        'name = "{}"'.format(PACKAGE_NAME),
+        'version = "{}"'.format(STARTING_VERSION),
+        '',
+        '[dependencies]',
+    ]
+    lines.extend('dependency{} = "0.{}.0"'.format(index, index) for index in range(dependencies))
+    return '\n'.join(lines) + '\n'
+
+def readme_content(lines):
+    content = ['# {}'.format(PACKAGE_NAME), '', '{} = {}'.format(PACKAGE_NAME, STARTING_VERSION)]
+    content.extend('Line {} of the generated documentation.'.format(index) for index in range(lines))
+    return '\n'.join(content) + '\n'
+
+def git(cwd, *args):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(('git',) + args, cwd=cwd, stdout=devnull)
+
+def new_release_context(release_type):
+    return release.ReleaseContext(
+        release_type,
+        'Cargo.toml',
+        'src/version.txt',
+        'README.md',
+        False,
+        False
+    )
+
+def timed(operation):
+    start = release.monotonic_time()
+    operation()
+    return release.monotonic_time() - start
+
+def bench_pipeline(release_type):
+    def benchmark():
+        release_context = new_release_context(release_type)
+        build_cmd = release.BUILD_CMD
+        release.BUILD_CMD = STUB_BUILD_CMD
+        # Accept the default version instead of prompting.
+        raw_input = __builtin__.raw_input
+        __builtin__.raw_input = lambda prompt: ''
+        try:
+            return timed(lambda: release.run_release(release_context))
+        finally:
+            release.BUILD_CMD = build_cmd
+            __builtin__.raw_input = raw_input
+    return benchmark
+
+def bench_method(prepare, operation):
+    # prepare runs untimed and returns the arguments for operation.
+    def benchmark():
+        release_context = new_release_context(release.RELEASE_TYPE_FINAL)
+        arguments = prepare(release_context)
+        return timed(lambda: operation(release_context, *arguments))
+    return benchmark
+
+def no_arguments(release_context):
+    return ()
+
+def prepare_commit(release_context):
+    crate = release.Crate(PACKAGE_NAME, release_context.cargo_file, release_context.version_file, release_context.readme_file)
+    release.update_crates_version_in_files(release_context, [(crate, '1.0.0')])
+    return ('Release commit for 1.0.0.',)
+
+def prepare_sync_index(release_context):
+    prepare_commit(release_context)
+    release_context.commit_release('Release commit for 1.0.0.')
+    return ()
+
+def prepare_push_release(release_context):
+    prepare_sync_index(release_context)
+    release_context.tag_release('v1.0.0', 'v1.0.0')
+    return ()
+
+def update_version_in_files(release_context):
+    crate = release.Crate(PACKAGE_NAME, release_context.cargo_file, release_context.version_file, release_context.readme_file)
+    release.update_crates_version_in_files(release_context, [(crate, '1.0.0')])
+
+def repo_is_dirty_with(dirty_check):
+    def operation(release_context):
+        release_context.dirty_check = dirty_check
+        return release_context.repo_is_dirty()
+    return operation
+
+BENCHMARKS = [
+    ('pipeline_snapshot', bench_pipeline(release.RELEASE_TYPE_SNAPSHOT)),
+    ('pipeline_final', bench_pipeline(release.RELEASE_TYPE_FINAL)),
+    ('repo_active_branch', bench_method(no_arguments, lambda rc: rc.repo_active_branch())),
+    ('repo_is_dirty', bench_method(no_arguments, lambda rc: rc.repo_is_dirty())),
+    ('repo_is_dirty_fast', bench_method(no_arguments, repo_is_dirty_with(release.DIRTY_CHECK_FAST))),
+    ('repo_is_dirty_paths', bench_method(no_arguments, repo_is_dirty_with(release.DIRTY_CHECK_PATHS))),
+    ('read_cargo_file', bench_method(no_arguments, release.read_cargo_file)),
+    ('update_version_in_files', bench_method(no_arguments, update_version_in_files)),
+    ('worktree_tree_hash', bench_method(no_arguments, lambda rc: rc.worktree_tree_hash())),
+    ('commit_release', bench_method(prepare_commit, lambda rc, message: rc.commit_release(message))),
+    ('sync_index', bench_method(prepare_sync_index, lambda rc: rc.sync_index())),
+    ('tag_release', bench_method(no_arguments, lambda rc: rc.tag_release('v1.0.0', 'v1.0.0'))),
+    ('merge_develop_into', bench_method(no_arguments, lambda rc: rc.merge_develop_into(release.BRANCH_MASTER))),
+    ('push_to_origin', bench_method(no_arguments, lambda rc: rc.push_to_origin())),
+    ('push_release', bench_method(prepare_push_release, lambda rc: rc.push_release())),
+]
+
+if __name__=='__main__':
+    main()
@@ -2,112 +2,670 @@
 
 import logging
 import argparse
+import contextlib
+import glob
+import hashlib
+import io
+import json
+import os
+import shutil
+import signal
+import stat
+import tempfile
+import threading
+import time
 from os import sys
-from git import Repo
-import contoml
-import semantic_version
 import re
 import subprocess
 import datetime
 
+# GitPython, contoml, semantic_version, multiprocessing and cProfile are
+# imported by the functions that use them.  Importing them up front costs
+# more than everything else the script does before it touches the
+# repository, so --help and argument errors would pay for them needlessly.
+
 RELEASE_TYPE_SNAPSHOT = 'snapshot'
 RELEASE_TYPE_FINAL = 'final'
 # testfinal is used to test final releases without committing to master.
 RELEASE_TYPE_TEST_FINAL = 'testfinal'
 SNAPSHOT = 'SNAPSHOT'
 BRANCH_DEVELOP = 'develop'
+BRANCH_MASTER = 'master'
+BRANCH_TEST_MASTER = 'testmaster'
 BUILD_CMD = 'cargo build --release'
+RELEASE_COMMIT_MESSAGE = 'Release commit for {}.'
+SNAPSHOT_COMMIT_MESSAGE = 'Rewrite version to SNAPSHOT.'
+NEXT_VERSION_COMMIT_MESSAGE = 'Bumped version to {}.'
+# The directory whose files are checksummed as the artifacts of a build.
+BUILD_ARTIFACT_DIR = 'target/release'
+TOOLCHAIN_VERSION_CMD = 'rustc --version --verbose'
+# Added to cargo commands so the build output can be read as it arrives.
+CARGO_MESSAGE_FORMAT = '--message-format=json'
+# The cargo subcommands that accept CARGO_MESSAGE_FORMAT.
+CARGO_JSON_SUBCOMMANDS = ('build', 'check', 'test', 'clippy', 'doc', 'bench', 'rustc')
+# The checks that can gate a release along with the build, by name.  cargo
+# package runs on the worktree before the release files are committed.
+CHECK_CMDS = {
+    'test': 'cargo test --release',
+    'clippy': 'cargo clippy --release -- -D warnings',
+    'package': 'cargo package --no-verify --allow-dirty',
+}
+# The stages each check waits for.  The build and the checks are independent
+# so they all run at once.
+CHECK_DEPENDENCIES = {}
+DEFAULT_CHECK_JOBS = 4
+# The directory the output of each check is written to, inside the target
+# directory.
+CHECK_LOG_DIR = 'vors-checks'
+# The error diagnostics and the lines of other output kept for the message
+# shown when a build fails.
+BUILD_MAX_DIAGNOSTICS = 10
+BUILD_TAIL_LINES = 40
+DEFAULT_BUILD_CACHE_DIR = '~/.cache/vors/build-cache'
+# Cached build results older than this, in seconds, are evicted.
+BUILD_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+# The oldest cached build results are evicted once the cache grows past this
+# many bytes.
+BUILD_CACHE_MAX_BYTES = 16 * 1024 * 1024
+# A Cargo.toml table header such as [package] or [[bin]].
+CARGO_TABLE_REGEX = re.compile(r'^\s*\[\[?\s*([^\]]+?)\s*\]\]?')
+# The name and version keys of a Cargo.toml table.  The first group is
+# everything before the string value and the second is the value.
+CARGO_NAME_REGEX = re.compile(r'^(\s*name\s*=\s*["\'])([^"\']*)["\']')
+CARGO_VERSION_REGEX = re.compile(r'^(\s*version\s*=\s*["\'])([^"\']*)["\']')
+CARGO_LOCK_FILE = 'Cargo.lock'
+# The cache of the version tag index, inside the git directory.
+TAG_INDEX_FILE = 'vors-tag-index.json'
+# A release tag is a prefix ending in v, such as v or vors-v, and a version.
+RELEASE_TAG_REGEX = re.compile(r'^(.*v)(\d+\.\d+\.\d+.*)$')
+# The cache of the version occurrence index, inside the git directory.
+VERSION_INDEX_FILE = 'vors-version-index.json'
+# A version wherever it appears, such as 1.2.3, 1.2.3-SNAPSHOT or 1.2.3+build.
+VERSION_OCCURRENCE_REGEX = re.compile(
+    r'(?<![\w.])\d+\.\d+\.\d+(?:-[0-9A-Za-z.-]*[0-9A-Za-z])?(?:\+[0-9A-Za-z.-]*[0-9A-Za-z])?(?!\w|\.\d)'
+)
+# Fewer files than this are scanned without starting worker processes.
+VERSION_INDEX_PARALLEL_FILES = 256
+# A semantic version, as semantic_version parses it.
+VERSION_COLUMNS_REGEX = re.compile(r'^(\d+)\.(\d+)\.(\d+)(?:-([0-9a-zA-Z.-]+))?(?:\+([0-9a-zA-Z.-]+))?$')
+# The journal of an unfinished release, inside the git directory.
+RELEASE_JOURNAL_FILE = 'vors-release-journal.json'
+# How the worktree is checked for uncommitted changes.  full is GitPython's
+# is_dirty, which diffs everything.  fast stops at the first difference and
+# paths only looks at the files the release rewrites.
+DIRTY_CHECK_FULL = 'full'
+DIRTY_CHECK_FAST = 'fast'
+DIRTY_CHECK_PATHS = 'paths'
+TRACE_FORMAT_JSON = 'json'
+TRACE_FORMAT_CHROME = 'chrome'
+DEFAULT_DAEMON_LOG_DIR = 'vors-daemon-logs'
+DEFAULT_FLEET_LOG_DIR = 'release-logs'
+DEFAULT_REMOTE = 'origin'
+DEFAULT_PUSH_RETRIES = 3
+# The wait before the first push retry, in seconds.  It doubles with every
+# retry.
+PUSH_RETRY_BACKOFF = 2
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('release_type', help='[ snapshot | final | testfinal]')
+    parser.add_argument('release_type', nargs='?', help='[ snapshot | final | testfinal]')
+    parser.add_argument('--version', help='Release this version instead of asking for one.')
     parser.add_argument('--cargo-file', default='Cargo.toml', help='The Cargo.toml file to use. Default = ./Cargo.toml')
     parser.add_argument('--version-file', default='./src/version.txt', help='The version.txt file to update. Default = ./src/version.txt')
     parser.add_argument('--readme-file', default='README.md', help='The readme file to update. Default = ./README.md')
     parser.add_argument('--disable-checks', action='store_true', default=False, help='Disable checks for testing purposes.')
     parser.add_argument('--dry-run', action='store_true', default=False, help='Run all commands that do no permanently alter the repository.')
+    parser.add_argument('--plan', action='store_true', default=False, help='Print what the release would do as JSON, without writing files, building or changing the repository.')
+    parser.add_argument('--resume', action='store_true', default=False, help='Finish a release that failed part way, starting after its last completed stage.')
+    parser.add_argument('--dirty-check', default=DIRTY_CHECK_FULL, choices=[DIRTY_CHECK_FULL, DIRTY_CHECK_FAST, DIRTY_CHECK_PATHS], help='How the worktree is checked for uncommitted changes: [ full | fast | paths ]. Default = {}'.format(DIRTY_CHECK_FULL))
+    parser.add_argument('--dirty-check-untracked', action='store_true', default=False, help='Count untracked files as uncommitted changes.')
+    parser.add_argument('--workspace', action='store_true', default=False, help='Release every member of the workspace defined by --cargo-file.')
+    parser.add_argument('--update-version-occurrences', action='store_true', default=False, help='Also rewrite the version wherever it appears next to the package name in the tracked files.')
+    parser.add_argument('--jobs', type=int, help='The number of worker processes used to update workspace members. Default = number of CPUs')
+    parser.add_argument('--build-cache-dir', default=DEFAULT_BUILD_CACHE_DIR, help='The directory build results are cached in. Default = {}'.format(DEFAULT_BUILD_CACHE_DIR))
+    parser.add_argument('--no-build-cache', action='store_true', default=False, help='Always build, ignoring any cached build result.')
+    parser.add_argument('--build-timeout', type=float, help='Stop the build when it runs longer than this many seconds. Default = no limit')
+    parser.add_argument('--build-idle-timeout', type=float, help='Stop the build when it prints nothing for this many seconds. Default = no limit')
+    parser.add_argument('--overlap-build', action='store_true', default=False, help='Build the release commit in a temporary linked worktree while the commit that follows it is prepared.')
+    parser.add_argument('--check', dest='checks', action='append', choices=sorted(CHECK_CMDS), help='Also run this check before committing the release, alongside the build. Can be given more than once. Default = none')
+    parser.add_argument('--check-jobs', type=int, default=DEFAULT_CHECK_JOBS, help='The number of checks, counting the build, run at once. Default = {}'.format(DEFAULT_CHECK_JOBS))
+    parser.add_argument('--fail-fast', action='store_true', default=False, help='Stop the build at its first error.')
+    parser.add_argument('--trace', help='Write the time and work spent in each release stage to this file.')
+    parser.add_argument('--trace-format', choices=[TRACE_FORMAT_JSON, TRACE_FORMAT_CHROME], default=TRACE_FORMAT_JSON, help='The format of the --trace file. Default = json')
+    parser.add_argument('--profile-dir', help='Write a cProfile of each release stage to this directory.')
+    parser.add_argument('--remote', dest='remotes', action='append', help='A remote to push the release to.  Repeat it to push to several remotes at once. Default = {}'.format(DEFAULT_REMOTE))
+    parser.add_argument('--push-retries', type=int, default=DEFAULT_PUSH_RETRIES, help='The number of times a failed push is retried. Default = {}'.format(DEFAULT_PUSH_RETRIES))
+    parser.add_argument('--fleet', metavar='PLAN_FILE', help='Release every repository listed in this JSON plan file concurrently.')
+    parser.add_argument('--max-releases', type=int, default=16, help='The number of fleet releases run at once. Default = 16')
+    parser.add_argument('--max-builds', type=int, default=2, help='The number of fleet builds run at once. Default = 2')
+    parser.add_argument('--max-git-ops', type=int, default=8, help='The number of fleet git operations (commit, tag, merge, push) run at once. Default = 8')
+    parser.add_argument('--fleet-log-dir', default=DEFAULT_FLEET_LOG_DIR, help='The directory the output of each fleet release is written to. Default = ./{}'.format(DEFAULT_FLEET_LOG_DIR))
+    parser.add_argument('--fleet-report', help='Write the fleet release summary to this JSON file.')
+    parser.add_argument('--daemon', metavar='SOCKET_PATH', help='Serve release requests on this Unix socket, keeping the repositories open between releases.')
+    parser.add_argument('--daemon-log-dir', default=DEFAULT_DAEMON_LOG_DIR, help='The directory the build output of each daemon release is written to. Default = ./{}'.format(DEFAULT_DAEMON_LOG_DIR))
+    parser.add_argument('--coalesce-snapshots', action='store_true', help='With --daemon, a snapshot request joins the snapshot release of the same repository that is still waiting to start, instead of queueing a release of its own.')
+    parser.add_argument('--snapshot-interval', type=float, default=0, help='With --daemon, the minimum number of seconds between the starts of two snapshot releases of a repository. Default = 0')
+    parser.add_argument('--submit', metavar='SOCKET_PATH', help='Send the release of the current directory to the daemon listening on this Unix socket.')
     args = parser.parse_args()
 
+    if args.daemon:
+        release_daemon = ReleaseDaemon(
+            args.daemon,
+            args.max_builds,
+            args.max_git_ops,
+            args.daemon_log_dir,
+            build_cache_dir=None if args.no_build_cache else os.path.expanduser(args.build_cache_dir),
+            coalesce_snapshots=args.coalesce_snapshots,
+            snapshot_interval=args.snapshot_interval
+        )
+        print 'Serving releases on {}.'.format(args.daemon)
+        try:
+            release_daemon.serve()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.submit:
+        result = submit_release(args.submit, {
+            'repo': os.getcwd(),
+            'release_type': args.release_type or '',
+            'version': args.version,
+            'cargo_file': args.cargo_file,
+            'version_file': args.version_file,
+            'readme_file': args.readme_file,
+            'workspace': args.workspace,
+            'dry_run': args.dry_run,
+            'resume': args.resume
+        })
+        if result['status'] != FLEET_STATUS_RELEASED:
+            print >>sys.stderr, result['error']
+            sys.exit(1)
+        return
+
+    if args.fleet:
+        fleet = Fleet(
+            args.max_releases,
+            args.max_builds,
+            args.max_git_ops,
+            args.fleet_log_dir,
+            build_cache_dir=None if args.no_build_cache else os.path.expanduser(args.build_cache_dir)
+        )
+        fleet_releases = read_fleet_plan(args.fleet)
+        invalid = [r for r in fleet_releases if r.status == FLEET_STATUS_INVALID]
+        if invalid:
+            print_fleet_summary(invalid)
+            sys.exit(1)
+        fleet.run(fleet_releases)
+        print_fleet_summary(fleet_releases)
+        if args.fleet_report:
+            write_fleet_report(args.fleet_report, fleet_releases)
+        if any(r.status != FLEET_STATUS_RELEASED for r in fleet_releases):
+            sys.exit(1)
+        return
+
     release_context = ReleaseContext(
-        args.release_type,
+        args.release_type or '',
         args.cargo_file,
         args.version_file,
         args.readme_file,
         args.disable_checks,
-        args.dry_run
+        args.dry_run,
+        workspace=args.workspace,
+        jobs=args.jobs or cpu_count(),
+        build_cache_dir=None if args.no_build_cache else os.path.expanduser(args.build_cache_dir),
+        trace=ReleaseTrace(profile_dir=args.profile_dir),
+        version=args.version,
+        remotes=args.remotes,
+        push_retries=args.push_retries,
+        resume=args.resume,
+        build_timeout=args.build_timeout,
+        build_idle_timeout=args.build_idle_timeout,
+        fail_fast=args.fail_fast,
+        interactive=not args.plan,
+        dirty_check=args.dirty_check,
+        dirty_check_untracked=args.dirty_check_untracked,
+        update_occurrences=args.update_version_occurrences,
+        overlap_build=args.overlap_build,
+        checks=args.checks,
+        check_jobs=args.check_jobs
     )
 
-    if (release_context.release_type != RELEASE_TYPE_SNAPSHOT
-        and release_context.release_type != RELEASE_TYPE_FINAL
-        and release_context.release_type != RELEASE_TYPE_TEST_FINAL):
-        print 'You must specify the relase type: [snapshot xor final xor testfinal]'
-        sys.exit(1)
+    if args.plan:
+        # Progress messages go to stderr so stdout is only the plan.
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        try:
+            plan = plan_release(release_context)
+        finally:
+            sys.stdout = stdout
+        print json.dumps(plan, indent=2, sort_keys=True)
+        return
 
-    if not release_context.disable_checks and release_context.repo_active_branch().lower() != BRANCH_DEVELOP:
-        print 'You must be on the develop branch in order to do a release. You are on branch {}'.format(release_context.repo_active_branch())
-        sys.exit(1)
+    if args.trace:
+        release_context.trace.count_subprocesses()
+    try:
+        run_release(release_context)
+    finally:
+        if args.trace:
+            release_context.trace.write(args.trace, args.trace_format)
 
-    if not release_context.disable_checks and release_context.repo_is_dirty():
-        print 'There are uncommited changes on the active branch.'
-        sys.exit(1)
+def run_release(release_context):
+    # Returns the tags of the release.  Each stage after the versions are
+    # chosen is recorded in the release journal, so a release that fails
+    # part way can be resumed without repeating the stages that finished.
+    check_release(release_context)
+    trace = release_context.trace
+    journal = release_context.read_journal()
+    if release_context.resume:
+        crate_versions = resume_release(release_context, journal)
+    else:
+        if journal is not None:
+            print 'A previous release did not finish. Run with --resume to finish it or delete {} to abandon it.'.format(journal.path)
+            sys.exit(1)
+        crate_versions = choose_release_versions(release_context)
+        journal = release_context.start_journal(crate_versions)
 
-    starting_version, package_name = read_cargo_file(release_context)
-    release_version = confirm_version(release_context, semantic_version.Version(starting_version))
-    print 'Releasing {} v{}'.format(package_name, str(release_version))
+    release_name = describe_crates(crate_versions)
+    if not journal.is_done('release_files'):
+        with trace.stage('update_version_in_files'):
+            update_crates_version_in_files(release_context, crate_versions)
+        journal.complete('release_files')
 
-    update_version_in_files(release_context, release_version, package_name)
+    if not journal.is_done('build'):
+        if release_context.overlap_build and not release_context.dry_run:
+            with trace.stage('overlapped_build'):
+                build_result, error = run_overlapped_build(release_context, journal, crate_versions)
+        else:
+            with trace.stage('attempt_build'), release_context.build_slot:
+                build_result, error = attempt_cached_build(release_context)
+        if build_result == 1:
+            print >>sys.stderr, 'Failed to build {}.  See build output for more information'.format(release_name)
+            if error:
+                print >>sys.stderr, error
+            sys.exit(1)
 
-    build_result, error = attempt_build()
-    if build_result == 1:
-        print >>sys.stderr, 'Failed to build {}.  See build output for more information'.format(package_name)
-        sys.exit(1)
+        if build_result == 2:
+            print >>sys.stderr, 'An exception occurred while trying to build {}:', error
+            sys.exit(2)
 
-    if build_result == 2:
-        print >>sys.stderr, 'An exception occurred while trying to build {}:', error
-        sys.exit(2)
+        print 'Successfully built {}.'.format(release_name)
+        journal.complete('build', build_cache_key=release_context.build_cache_key)
 
-    print 'Successfully built {}.'.format(package_name)
+    if not journal.is_done('release_commit'):
+        commit_release_versions(release_context, crate_versions)
+        journal.complete('release_commit', release_commit=release_context.repo_head(), **release_context.journal_state())
+    release_commit = journal.state['release_commit']
 
-    if not release_context.dry_run:
-        release_context.commit_release('Release commit for {}.'.format(str(release_version)))
+    tags = [release_tag(release_context, crate, release_version) for crate, release_version in crate_versions]
+    if not journal.is_done('tags'):
+        with trace.stage('tag_release'), release_context.git_slot:
+            for tag in tags:
+                # A resumed release may have created some of its tags already.
+                if not release_context.dry_run and tag not in release_context.tag_index():
+                    release_context.tag_release(tag, tag, release_commit)
 
-    print 'Committed release v{} to {}.'.format(
-        str(release_version),
-        release_context.repo_active_branch()
-    )
+                print 'Tagged release {} to {}.'.format(
+                    tag,
+                    release_context.repo_active_branch()
+                )
+        journal.complete('tags', **release_context.journal_state())
+
+    if release_context.is_final_release() or release_context.is_test_final_release():
+        if not journal.is_done('merge'):
+            with trace.stage('merge_develop'), release_context.git_slot:
+                if release_context.is_final_release():
+                    release_context.merge_develop_into(BRANCH_MASTER, release_commit)
+                else:
+                    release_context.merge_develop_into(BRANCH_TEST_MASTER, release_commit)
+            journal.complete('merge', **release_context.journal_state())
+
+    files_stage, commit_stage = next_version_stages(release_context)
+    if not journal.is_done(files_stage):
+        update_next_versions(release_context, crate_versions)
+        journal.complete(files_stage)
+    if not journal.is_done(commit_stage):
+        commit_next_versions(release_context, crate_versions)
+        journal.complete(commit_stage, **release_context.journal_state())
+
+    with trace.stage('sync_index'):
+        release_context.sync_index()
 
-    tag = 'v{}'.format(str(release_version))
     if not release_context.dry_run:
-        release_context.tag_release(tag, tag)
+        print 'Pushing release to {}.'.format(', '.join(release_context.remotes))
+        with trace.stage('push_to_origin'), release_context.git_slot:
+            push_errors = release_context.push_release()
+        if push_errors:
+            for remote, error in push_errors:
+                print >>sys.stderr, 'Failed to push the release to {}: {}'.format(remote, error)
+            print >>sys.stderr, 'Run with --resume to retry the push.'
+            sys.exit(1)
 
-    print 'Tagged release v{} to {}.'.format(
-        str(release_version),
+    journal.remove()
+    return tags
+
+def commit_release_versions(release_context, crate_versions):
+    release_versions = describe_versions(crate_versions)
+    with release_context.trace.stage('commit_release'), release_context.git_slot:
+        if not release_context.dry_run:
+            release_context.commit_release(RELEASE_COMMIT_MESSAGE.format(release_versions))
+
+    print 'Committed release {} to {}.'.format(
+        release_versions,
         release_context.repo_active_branch()
     )
 
+def next_version_stages(release_context):
+    # The journal stages that write and commit the versions following the
+    # release.
     if release_context.is_snapshot_release():
-        snapshot_version = to_snapshot_version(release_version)
-        update_version_in_files(release_context, snapshot_version, package_name)
-        print 'Updated files with SNAPSHOT specifier.'
-        if not release_context.dry_run:
-            release_context.commit_release('Rewrite version to SNAPSHOT.')
+        return ('snapshot_files', 'snapshot_commit')
+    return ('next_files', 'next_commit')
 
-    if release_context.is_final_release() or release_context.is_test_final_release():
-        if release_context.is_final_release():
-            release_context.checkout_master()
-        else:
-            release_context.checkout_test_master()
-        release_context.merge_develop()
-        release_context.checkout_develop()
-        next_version = to_next_patch_snapshot_version(release_version)
-        update_version_in_files(release_context, next_version, package_name)
-        print 'Updated files with SNAPSHOT specifier.'
+def to_next_versions(release_context, crate_versions):
+    if release_context.is_snapshot_release():
+        return [(crate, to_snapshot_version(v)) for crate, v in crate_versions]
+    return [(crate, to_next_patch_snapshot_version(v)) for crate, v in crate_versions]
+
+def update_next_versions(release_context, crate_versions):
+    with release_context.trace.stage('update_version_in_files'):
+        update_crates_version_in_files(release_context, to_next_versions(release_context, crate_versions))
+    print 'Updated files with SNAPSHOT specifier.'
+
+def commit_next_versions(release_context, crate_versions):
+    if release_context.is_snapshot_release():
+        message = SNAPSHOT_COMMIT_MESSAGE
+    else:
+        message = NEXT_VERSION_COMMIT_MESSAGE.format(describe_versions(to_next_versions(release_context, crate_versions)))
+    with release_context.trace.stage('commit_release'), release_context.git_slot:
         if not release_context.dry_run:
-            release_context.commit_release('Bumped version to {}.'.format(next_version))
+            release_context.commit_release(message)
 
-    if not release_context.dry_run:
-        print "Pushing release to origin."
-        release_context.push_to_origin()
+def run_overlapped_build(release_context, journal, crate_versions):
+    # Commits the release and builds it in a linked worktree while the main
+    # worktree writes and commits the versions that follow it, which do not
+    # depend on the build.  When the build fails both commits are discarded
+    # and the release starts again from scratch.  The journal only records
+    # the commits once the build has succeeded, so a release interrupted
+    # part way cannot be resumed from a worktree that was not built.
+    original_head = release_context.repo_head()
+    commit_release_versions(release_context, crate_versions)
+    release_commit = release_context.repo_head()
+
+    build_results = []
+    def build(build_dir, tree_hash):
+        with release_context.build_slot:
+            build_results.append(attempt_cached_build(release_context, build_dir, tree_hash))
+
+    with release_context.linked_worktree(release_commit) as build_dir:
+        print 'Building {} in {}.'.format(release_commit, build_dir)
+        build_thread = start_thread(build, build_dir, release_context.commit_tree_hash(release_commit))
+        try:
+            update_next_versions(release_context, crate_versions)
+            commit_next_versions(release_context, crate_versions)
+        finally:
+            build_thread.join()
+
+    build_result, error = build_results[0] if build_results else (2, 'The build did not run.')
+    if build_result != 0:
+        with release_context.git_slot:
+            release_context.discard_commits(original_head)
+        journal.remove()
+        print 'Discarded the release commits.'
+        return (build_result, error)
+
+    files_stage, commit_stage = next_version_stages(release_context)
+    journal.complete('release_commit', release_commit=release_commit, **release_context.journal_state())
+    journal.complete(files_stage)
+    journal.complete(commit_stage, **release_context.journal_state())
+    return (build_result, error)
+
+def start_thread(target, *args):
+    # Starts target on a thread that prints where the calling thread prints,
+    # even when a fleet or the daemon routes each thread's output.
+    streams = [
+        stream.current() if isinstance(stream, ThreadOutput) else None
+        for stream in (sys.stdout, sys.stderr)
+    ]
+    def run():
+        for stream, thread_stream in zip((sys.stdout, sys.stderr), streams):
+            if thread_stream is not None:
+                stream.register(thread_stream)
+        target(*args)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+def check_release(release_context):
+    if (release_context.release_type != RELEASE_TYPE_SNAPSHOT
+        and release_context.release_type != RELEASE_TYPE_FINAL
+        and release_context.release_type != RELEASE_TYPE_TEST_FINAL):
+        print 'You must specify the relase type: [snapshot xor final xor testfinal]'
+        sys.exit(1)
+
+    with release_context.trace.stage('check_branch'):
+        if not release_context.disable_checks and release_context.repo_active_branch().lower() != BRANCH_DEVELOP:
+            print 'You must be on the develop branch in order to do a release. You are on branch {}'.format(release_context.repo_active_branch())
+            sys.exit(1)
+
+def plan_release(release_context):
+    # Works out everything the release would do, without writing files,
+    # building or touching the repository: the versions, the diff of every
+    # file, and the commits, tags, merges and refs pushed.  Returns the plan
+    # as a JSON-able dict.
+    check_release(release_context)
+    crate_versions = choose_release_versions(release_context)
+    planned_files = PlannedFiles()
+    branch = release_context.repo_active_branch()
+    release_versions = describe_versions(crate_versions)
+    steps = [
+        plan_version_updates(release_context, planned_files, crate_versions),
+        {'action': 'build', 'command': BUILD_CMD},
+    ]
+    steps.extend({'action': 'check', 'name': check, 'command': CHECK_CMDS[check]} for check in release_context.checks)
+    steps.append({'action': 'commit', 'branch': branch, 'message': RELEASE_COMMIT_MESSAGE.format(release_versions)})
+    tags = [release_tag(release_context, crate, release_version) for crate, release_version in crate_versions]
+    steps.extend({'action': 'tag', 'tag': tag, 'branch': branch} for tag in tags)
+    refs = ['refs/heads/{}'.format(branch)] + ['refs/tags/{}'.format(tag) for tag in tags]
+
+    if release_context.is_snapshot_release():
+        next_versions = [(crate, to_snapshot_version(v)) for crate, v in crate_versions]
+        next_message = SNAPSHOT_COMMIT_MESSAGE
+    else:
+        target = BRANCH_MASTER if release_context.is_final_release() else BRANCH_TEST_MASTER
+        steps.append({
+            'action': 'merge',
+            'from': branch,
+            'into': target,
+            'fast_forward': release_context.can_fast_forward(target)
+        })
+        refs.append('refs/heads/{}'.format(target))
+        next_versions = [(crate, to_next_patch_snapshot_version(v)) for crate, v in crate_versions]
+        next_message = NEXT_VERSION_COMMIT_MESSAGE.format(describe_versions(next_versions))
+    steps.append(plan_version_updates(release_context, planned_files, next_versions))
+    steps.append({'action': 'commit', 'branch': branch, 'message': next_message})
+    steps.append({'action': 'push', 'remotes': release_context.remotes, 'refs': refs})
+
+    return {
+        'release_type': release_context.release_type,
+        'branch': branch,
+        'crates': [
+            {
+                'name': crate.name,
+                'release_version': str(release_version),
+                'next_version': str(next_version)
+            }
+            for (crate, release_version), (_, next_version) in zip(crate_versions, next_versions)
+        ],
+        'tags': tags,
+        'steps': steps
+    }
+
+class PlannedFiles:
+    # The content files would have part way through a planned release.
+    # Files are read from disk until the plan changes them.
+    def __init__(self):
+        self.contents = {}
+
+    def read(self, path):
+        if path not in self.contents:
+            try:
+                with open(path, 'rb') as planned_file:
+                    self.contents[path] = planned_file.read()
+            except IOError:
+                self.contents[path] = None
+        return self.contents[path]
+
+    def write(self, path, content):
+        # Returns the diff of the change.
+        import difflib
+        old_content = self.read(path) or ''
+        self.contents[path] = content
+        diff = difflib.unified_diff(
+            old_content.splitlines(True),
+            content.splitlines(True),
+            'a/{}'.format(path),
+            'b/{}'.format(path)
+        )
+        # Marked the way git marks a last line without a newline.
+        return ''.join(
+            line if line.endswith('\n') else line + '\n\\ No newline at end of file\n'
+            for line in diff
+        )
+
+def plan_version_updates(release_context, planned_files, crate_versions):
+    # The files update_crates_version_in_files would change and their diffs.
+    files = []
+    lock_versions = {}
+    def write(path, content):
+        if content != planned_files.read(path):
+            files.append({'path': path, 'diff': planned_files.write(path, content)})
+
+    for crate, version in crate_versions:
+        version = str(version)
+        cargo_content = planned_files.read(crate.cargo_file)
+        manifest = CargoManifest(crate.cargo_file, cargo_content)
+        lock_versions[crate.name] = (manifest.version, version)
+        start, end = manifest.version_span
+        write(crate.cargo_file, cargo_content[:start] + version + cargo_content[end:])
+        if crate.version_file:
+            write(crate.version_file, version)
+        if crate.readme_file and planned_files.read(crate.readme_file) is not None:
+            write(crate.readme_file, rewrite_content(
+                planned_files.read(crate.readme_file),
+                ReadmeVersionRewriter(crate.name, version)
+            ))
+
+    cargo_lock_file = os.path.join(os.path.dirname(release_context.cargo_file), CARGO_LOCK_FILE)
+    if planned_files.read(cargo_lock_file) is not None:
+        write(cargo_lock_file, rewrite_content(planned_files.read(cargo_lock_file), CargoLockRewriter(lock_versions)))
+
+    if release_context.update_occurrences:
+        index = release_context.version_occurrence_index(lock_versions.keys())
+        for path in index.paths(lock_versions.keys()):
+            path = os.path.relpath(os.path.join(index.work_dir, path))
+            write(path, rewrite_version_occurrences(planned_files.read(path), lock_versions))
+
+    return {'action': 'update_files', 'files': files}
+
+def rewrite_content(content, rewrite_line):
+    # rewrite_file for content held in memory.
+    rewritten = [rewrite_line(line) for line in content.splitlines(True)]
+    if hasattr(rewrite_line, 'finish'):
+        rewritten.append(rewrite_line.finish())
+    return ''.join(rewritten)
+
+def choose_release_versions(release_context):
+    # Returns the crates of the release paired with their release versions.
+    trace = release_context.trace
+    with trace.stage('check_dirty'):
+        if not release_context.disable_checks:
+            start = monotonic_time()
+            dirty = release_context.repo_is_dirty()
+            print 'Checked for uncommitted changes in {:.3f}s ({} check).'.format(monotonic_time() - start, release_context.dirty_check)
+            if dirty:
+                print 'There are uncommited changes on the active branch.'
+                sys.exit(1)
+
+    if release_context.workspace:
+        with trace.stage('read_cargo_file'):
+            crate_versions = read_workspace_release_versions(release_context)
+        if not crate_versions:
+            print 'No workspace members were found in {}.'.format(release_context.cargo_file)
+            sys.exit(1)
+    else:
+        with trace.stage('read_cargo_file'):
+            starting_version, package_name = read_cargo_file(release_context)
+        with trace.stage('read_tag_index'):
+            import semantic_version
+            # The version offered by default skips versions already tagged.
+            starting_version = to_free_starting_version(
+                release_context,
+                release_context.tag_index(),
+                release_tag_prefix(release_context, package_name),
+                semantic_version.Version(starting_version)
+            )
+        with trace.stage('confirm_version'):
+            if release_context.version:
+                release_version = to_proposed_release_version(release_context)
+            elif not release_context.interactive:
+                release_version = to_default_release_version(release_context, starting_version)
+            else:
+                release_version = confirm_version(release_context, starting_version)
+        crate = Crate(
+            package_name,
+            release_context.cargo_file,
+            release_context.version_file,
+            release_context.readme_file
+        )
+        crate_versions = [(crate, release_version)]
+
+    # An existing tag would make tag_release fail after the build, so it is
+    # caught before anything is written.
+    with trace.stage('check_tags'):
+        tag_index = release_context.tag_index()
+        existing_tags = [
+            (crate, release_version) for crate, release_version in crate_versions
+            if release_tag(release_context, crate, release_version) in tag_index
+        ]
+    if existing_tags:
+        for crate, release_version in existing_tags:
+            prefix = release_tag_prefix(release_context, crate.name)
+            print >>sys.stderr, '{} already exists. The next free versions are {} and {}.'.format(
+                release_tag(release_context, crate, release_version),
+                tag_index.next_free_patch(prefix, release_version),
+                tag_index.next_free_minor(prefix, release_version)
+            )
+        sys.exit(1)
+
+    for crate, release_version in crate_versions:
+        print 'Releasing {} v{}'.format(crate.name, str(release_version))
+
+    return crate_versions
+
+def resume_release(release_context, journal):
+    # Returns the crates and versions of the release recorded in journal.
+    if journal is None:
+        print 'There is no unfinished release to resume.'
+        sys.exit(1)
+
+    if journal.state['release_type'] != release_context.release_type:
+        print 'The unfinished release is a {} release, not a {} release.'.format(
+            journal.state['release_type'],
+            release_context.release_type
+        )
+        sys.exit(1)
+
+    # The journal only describes the repository as the release left it.
+    head = journal.state.get('head')
+    if head is not None and head != release_context.repo_head():
+        print 'HEAD has moved since the unfinished release stopped. It cannot be resumed.'
+        sys.exit(1)
+
+    release_context.restore_journal_state(journal.state)
+    crate_versions = journal.crate_versions()
+    for crate, release_version in crate_versions:
+        print 'Resuming the release of {} v{} after {}.'.format(crate.name, str(release_version), journal.state['stages'][-1])
+    return crate_versions
 
 # end of main
 
@@ -119,7 +677,30 @@ class ReleaseContext:
         version_file,
         readme_file,
         disable_checks,
-        dry_run
+        dry_run,
+        workspace=False,
+        jobs=1,
+        build_cache_dir=None,
+        trace=None,
+        version=None,
+        repo_dir='.',
+        build_slot=None,
+        git_slot=None,
+        output=None,
+        interactive=True,
+        remotes=None,
+        push_retries=DEFAULT_PUSH_RETRIES,
+        resume=False,
+        repo=None,
+        build_timeout=None,
+        build_idle_timeout=None,
+        fail_fast=False,
+        dirty_check=DIRTY_CHECK_FULL,
+        dirty_check_untracked=False,
+        update_occurrences=False,
+        overlap_build=False,
+        checks=None,
+        check_jobs=DEFAULT_CHECK_JOBS
     ):
         # Either final or snapshot
         self.release_type = release_type.lower()
@@ -135,25 +716,300 @@ class ReleaseContext:
         # Do everything non destructively.  That is, the script will run with
         # output but nothing will actually be committed.
         self.dry_run = dry_run
-        # The git repo.
-        self._repo = Repo('.')
+        # Release every member of the workspace defined by cargo_file instead
+        # of the single package it describes.
+        self.workspace = workspace
+        # The number of worker processes used to update workspace members.
+        self.jobs = jobs
+        # The directory build results are cached in.  None disables the cache.
+        self.build_cache_dir = build_cache_dir
+        # Records the time and work spent in each stage of the release.
+        self.trace = trace or ReleaseTrace()
+        # The version to release.  When None the user is asked for one.
+        self.version = version
+        # The root of the repository.  The file paths above are relative to
+        # the current directory, not to repo_dir.
+        self.repo_dir = repo_dir
+        # Held while building and while running git operations so
+        # concurrent releases can be limited.
+        self.build_slot = build_slot or NullSlot()
+        self.git_slot = git_slot or NullSlot()
+        # The file the build output is written to.  None leaves it on stdout.
+        self.output = output
+        # The build is stopped when it runs longer than build_timeout or
+        # prints nothing for build_idle_timeout seconds, and with fail_fast
+        # at its first error.
+        self.build_timeout = build_timeout
+        self.build_idle_timeout = build_idle_timeout
+        self.fail_fast = fail_fast
+        # How repo_is_dirty checks the worktree, and whether untracked files
+        # count as changes.
+        self.dirty_check = dirty_check
+        self.dirty_check_untracked = dirty_check_untracked
+        # Rewrite the version everywhere the version occurrence index finds
+        # it, not only in the files above.
+        self.update_occurrences = update_occurrences
+        # Build the release commit in a linked worktree while the versions
+        # that follow it are written and committed.
+        self.overlap_build = overlap_build
+        # The checks run with the build, from CHECK_CMDS, and how many of
+        # them run at once.
+        self.checks = checks or []
+        self.check_jobs = check_jobs
+        # When False the default version is released instead of asking for
+        # one, so the release never waits for input.
+        self.interactive = interactive
+        # The remotes the release is pushed to and how often a failed push
+        # is retried.
+        self.remotes = remotes or [DEFAULT_REMOTE]
+        self.push_retries = push_retries
+        # The refs the release created or moved, in order.  Only these are
+        # pushed.
+        self.release_refs = []
+        # Continue the release recorded in the release journal.
+        self.resume = resume
+        # The key of the build result in the build cache, once built.
+        self.build_cache_key = None
+        # The git repo is opened by __getattr__ the first time _repo is used,
+        # unless an open one is passed in, such as one the daemon keeps warm.
+        if repo is not None:
+            self._repo = repo
+        # Files updated since the last release commit.  Only these are
+        # written into the next commit.
+        self._changed_paths = set()
+        # Files committed without updating the index.  Their index entries
+        # are refreshed by sync_index.
+        self._unsynced_paths = set()
+
+    def __getattr__(self, name):
+        if name == '_repo':
+            from git import Repo
+            self._repo = Repo(self.repo_dir)
+            return self._repo
+        raise AttributeError(name)
 
     def repo_active_branch(self):
         return self._repo.active_branch.name
 
     def repo_is_dirty(self):
-        return self._repo.is_dirty()
+        if self.dirty_check == DIRTY_CHECK_FULL:
+            return self._repo.is_dirty(untracked_files=self.dirty_check_untracked)
+
+        paths = self.release_paths() if self.dirty_check == DIRTY_CHECK_PATHS else []
+        pathspec = ['--'] + [
+            os.path.relpath(os.path.realpath(path), os.path.realpath(self._repo.working_tree_dir))
+            for path in paths
+        ]
+        # --quiet makes git stop at the first difference.  The worktree diff
+        # refreshes the index through fsmonitor when it is configured.
+        for diff_args in (['--cached', 'HEAD'], []):
+            status, _, _ = self._repo.git.diff(
+                '--quiet', *(diff_args + pathspec),
+                with_extended_output=True,
+                with_exceptions=False
+            )
+            if status != 0:
+                return True
+
+        if self.dirty_check_untracked:
+            # status uses the untracked cache when it is enabled.  Only the
+            # first untracked file is read.
+            status_process = subprocess.Popen(
+                ['git', 'status', '--porcelain', '--untracked-files=normal'] + pathspec,
+                cwd=self._repo.working_tree_dir,
+                stdout=subprocess.PIPE
+            )
+            untracked = False
+            for line in iter(status_process.stdout.readline, ''):
+                if line.startswith('??'):
+                    untracked = True
+                    break
+            if status_process.poll() is None:
+                status_process.kill()
+            status_process.wait()
+            return untracked
+
+        return False
+
+    def release_paths(self):
+        # The files the release rewrites.
+        if self.workspace:
+            crates = read_workspace_members(self)
+        else:
+            crates = [Crate(None, self.cargo_file, self.version_file, self.readme_file)]
+        paths = [os.path.join(os.path.dirname(self.cargo_file), CARGO_LOCK_FILE)]
+        for crate in crates:
+            paths.extend(path for path in (crate.cargo_file, crate.version_file, crate.readme_file) if path)
+        return paths
+
+    def worktree_tree_hash(self):
+        # The hash of the tree that committing the tracked files would produce.
+        # It is computed against a scratch copy of the index so the real
+        # index is left untouched.
+        scratch_index = tempfile.NamedTemporaryFile(prefix='vors-index-', delete=False)
+        scratch_index.close()
+        try:
+            index_path = os.path.join(self._repo.git_dir, 'index')
+            if os.path.exists(index_path):
+                shutil.copyfile(index_path, scratch_index.name)
+            else:
+                os.remove(scratch_index.name)
+            with self._repo.git.custom_environment(GIT_INDEX_FILE=scratch_index.name):
+                self._repo.git.add(update=True)
+                return self._repo.git.write_tree()
+        finally:
+            if os.path.exists(scratch_index.name):
+                os.remove(scratch_index.name)
+
+    def mark_changed(self, *paths):
+        for path in paths:
+            if path:
+                self._changed_paths.add(
+                    os.path.relpath(os.path.abspath(path), self._repo.working_tree_dir)
+                )
+
+    def mark_changed_if_tracked(self, path):
+        relative_path = os.path.relpath(os.path.abspath(path), self._repo.working_tree_dir)
+        try:
+            self._repo.head.commit.tree[relative_path.replace(os.sep, '/')]
+        except KeyError:
+            return
+        self._changed_paths.add(relative_path)
+
+    def record_release_ref(self, ref):
+        if ref not in self.release_refs:
+            self.release_refs.append(ref)
+
+    def tag_index(self):
+        return VersionTagIndex(self._repo.git_dir)
+
+    def version_occurrence_index(self, names):
+        return VersionOccurrenceIndex(self._repo.working_tree_dir, self._repo.git_dir, names, self.jobs)
+
+    def repo_head(self):
+        return self._repo.head.commit.hexsha
+
+    def read_journal(self):
+        return ReleaseJournal.read(os.path.join(self._repo.git_dir, RELEASE_JOURNAL_FILE))
+
+    def start_journal(self, crate_versions):
+        # A dry run changes nothing so there is nothing to resume.
+        path = None if self.dry_run else os.path.join(self._repo.git_dir, RELEASE_JOURNAL_FILE)
+        journal = ReleaseJournal(path, {
+            'release_type': self.release_type,
+            'workspace': self.workspace,
+            'crates': [
+                {
+                    'name': crate.name,
+                    'cargo_file': crate.cargo_file,
+                    'version_file': crate.version_file,
+                    'readme_file': crate.readme_file,
+                    'version': str(version)
+                }
+                for crate, version in crate_versions
+            ],
+            'stages': []
+        })
+        journal.complete('versions', **self.journal_state())
+        return journal
+
+    def journal_state(self):
+        # The repository state a resumed release needs to carry on.
+        return {
+            'head': self.repo_head(),
+            'release_refs': self.release_refs,
+            'unsynced_paths': sorted(self._unsynced_paths)
+        }
+
+    def restore_journal_state(self, state):
+        self.release_refs = list(state.get('release_refs', []))
+        self._unsynced_paths.update(state.get('unsynced_paths', []))
+        self.build_cache_key = state.get('build_cache_key')
 
     def commit_release(self, message):
-        self._repo.git.add(update=True)
-        self._repo.index.commit(message)
+        self.record_release_ref('refs/heads/{}'.format(self.repo_active_branch()))
+        if not self._changed_paths:
+            self._repo.git.add(update=True)
+            self._repo.index.commit(message)
+            return
 
-    def tag_release(self, tag, tag_message):
-        self._repo.create_tag(tag, message=tag_message)
+        # The changed files are written straight into the object database and
+        # the new tree is derived from the parent's by replacing only their
+        # entries, so neither the index nor the rest of the worktree is read.
+        from git.objects import Commit, Tree
+        parent_commit = self._repo.head.commit
+        changes = {}
+        for path in self._changed_paths:
+            changes[tuple(path.split(os.sep))] = self._store_blob(path)
+        tree_binsha = write_tree_with_changes(self._repo.odb, parent_commit.tree.binsha, changes)
+        changed_trees = set(path[:depth] for path in changes for depth in range(len(path)))
+        self.trace.count('git_objects', len(changes) + len(changed_trees) + 1)
+        Commit.create_from_tree(
+            self._repo,
+            Tree(self._repo, tree_binsha),
+            message,
+            parent_commits=[parent_commit],
+            head=True
+        )
+        self._unsynced_paths.update(self._changed_paths)
+        self._changed_paths.clear()
+
+    def _store_blob(self, path):
+        from gitdb import IStream
+        full_path = os.path.join(self._repo.working_tree_dir, path)
+        mode = os.stat(full_path).st_mode
+        git_mode = 0o100755 if mode & stat.S_IXUSR else 0o100644
+        with open(full_path, 'rb') as blob_file:
+            blob = self._repo.odb.store(IStream('blob', os.path.getsize(full_path), blob_file))
+        return (blob.binsha, git_mode)
+
+    def sync_index(self):
+        # Brings the index entries of files committed by commit_release up to
+        # date.  It must run before anything that relies on the index, such
+        # as a checkout or a merge.
+        if self._unsynced_paths:
+            self._repo.git.update_index('--add', '--', *sorted(self._unsynced_paths))
+            self._unsynced_paths.clear()
+
+    def tag_release(self, tag, tag_message, commit='HEAD'):
+        self._repo.create_tag(tag, ref=commit, message=tag_message)
+        self.record_release_ref('refs/tags/{}'.format(tag))
+        self.trace.count('git_objects')
 
     def push_to_origin(self):
         self._repo.remotes.origin.push('refs/heads/*:refs/heads/*', tags=True)
 
+    def push_release(self):
+        # Pushes only the refs the release created or moved, atomically, to
+        # every remote at once.  Returns a (remote, error) pair for each
+        # remote that still failed after the retries.
+        if not self.release_refs:
+            return []
+
+        refspecs = ['{0}:{0}'.format(ref) for ref in self.release_refs]
+        errors = []
+        threads = [
+            threading.Thread(target=self._push_to_remote, args=(remote, refspecs, errors))
+            for remote in self.remotes
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sorted(errors)
+
+    def _push_to_remote(self, remote, refspecs, errors):
+        from git.exc import GitCommandError
+        for attempt in range(self.push_retries + 1):
+            try:
+                self._repo.git.push('--atomic', '--porcelain', remote, *refspecs)
+                return
+            except GitCommandError as e:
+                if attempt == self.push_retries:
+                    errors.append((remote, e))
+                else:
+                    time.sleep(PUSH_RETRY_BACKOFF * 2 ** attempt)
+
     def is_snapshot_release(self):
         return self.release_type == RELEASE_TYPE_SNAPSHOT
 
@@ -164,21 +1020,691 @@ class ReleaseContext:
         return self.release_type == RELEASE_TYPE_TEST_FINAL
 
     def checkout_master(self):
+        self.sync_index()
         self._repo.heads.master.checkout()
 
     def checkout_test_master(self):
+        self.sync_index()
         self._repo.heads.testmaster.checkout()
 
     def checkout_develop(self):
+        self.sync_index()
         self._repo.heads.develop.checkout()
 
-    def merge_develop(self):
-        self._repo.git.merge(BRANCH_DEVELOP)
+    def merge_develop(self, commit=BRANCH_DEVELOP):
+        self.sync_index()
+        self._repo.git.merge(commit)
 
-def read_cargo_file(release_context):
+    def merge_develop_into(self, branch, commit=None):
+        # Merges develop, or the develop commit given, into branch by moving
+        # the branch ref, so the worktree stays on develop and no files are
+        # rewritten.  A merge that is not a fast-forward is computed in
+        # memory with merge-tree.  When that is not possible (branch is
+        # checked out, the merge conflicts or git is too old) the branch is
+        # checked out and merged as usual.
+        from git.exc import GitCommandError
+        from git.objects import Commit
+        self.record_release_ref('refs/heads/{}'.format(branch))
+        develop_commit = self._repo.commit(commit) if commit else self._repo.heads[BRANCH_DEVELOP].commit
+        branch_commit = self._repo.heads[branch].commit
+        if self.repo_active_branch() != branch:
+            if self._is_ancestor(branch_commit, develop_commit):
+                self._update_branch(branch, develop_commit, branch_commit, 'merge {}: Fast-forward'.format(BRANCH_DEVELOP))
+                return
+
+            try:
+                tree = self._repo.git.merge_tree('--write-tree', branch_commit.hexsha, develop_commit.hexsha)
+            except GitCommandError:
+                tree = None
+
+            if tree:
+                message = "Merge branch '{}'".format(BRANCH_DEVELOP)
+                if branch != BRANCH_MASTER:
+                    message += ' into {}'.format(branch)
+                self.trace.count('git_objects')
+                merge_commit = Commit.create_from_tree(
+                    self._repo,
+                    self._repo.tree(tree.splitlines()[0]),
+                    message,
+                    parent_commits=[branch_commit, develop_commit]
+                )
+                self._update_branch(branch, merge_commit, branch_commit, 'merge {}: Merge made by merge-tree.'.format(BRANCH_DEVELOP))
+                return
+
+        self.sync_index()
+        self._repo.heads[branch].checkout()
+        self.merge_develop(develop_commit.hexsha)
+        self.checkout_develop()
+
+    @contextlib.contextmanager
+    def linked_worktree(self, commit):
+        # A temporary worktree of the repository with commit checked out.
+        worktree_dir = tempfile.mkdtemp(prefix='vors-build-')
+        self._repo.git.worktree('add', '--detach', worktree_dir, commit)
+        try:
+            yield worktree_dir
+        finally:
+            self._repo.git.worktree('remove', '--force', worktree_dir)
+            if os.path.isdir(worktree_dir):
+                shutil.rmtree(worktree_dir)
+
+    def commit_tree_hash(self, commit):
+        return self._repo.commit(commit).tree.hexsha
+
+    def discard_commits(self, head):
+        # Moves the active branch back to head and restores the files the
+        # discarded commits changed, in the index and the worktree.
+        branch = self.repo_active_branch()
+        discarded_head = self.repo_head()
+        changed_paths = self._repo.git.diff('--name-only', head, discarded_head).splitlines()
+        self._repo.git.update_ref('refs/heads/{}'.format(branch), head, discarded_head)
+        if changed_paths:
+            self._repo.git.checkout(head, '--', *changed_paths)
+        self._changed_paths.clear()
+        self._unsynced_paths.clear()
+        self.release_refs = [ref for ref in self.release_refs if ref != 'refs/heads/{}'.format(branch)]
+
+    def can_fast_forward(self, branch):
+        # True when merging develop into branch only moves branch forward.
+        return self._is_ancestor(self._repo.heads[branch].commit, self._repo.heads[BRANCH_DEVELOP].commit)
+
+    def _is_ancestor(self, ancestor_commit, commit):
+        from git.exc import GitCommandError
+        try:
+            self._repo.git.merge_base('--is-ancestor', ancestor_commit.hexsha, commit.hexsha)
+            return True
+        except GitCommandError:
+            return False
+
+    def _update_branch(self, branch, new_commit, old_commit, message):
+        # The old value makes the update fail if the branch moved meanwhile.
+        self._repo.git.update_ref(
+            '-m', message,
+            'refs/heads/{}'.format(branch),
+            new_commit.hexsha,
+            old_commit.hexsha
+        )
+
+def write_tree_with_changes(odb, tree_binsha, changes):
+    # Writes a copy of the tree tree_binsha with changes applied and returns
+    # its binsha.  changes maps a path, as a tuple of names, to the
+    # (binsha, mode) of its new blob.  Only the trees along the changed paths
+    # are read and written.
+    from git.objects.fun import tree_entries_from_data, tree_to_stream
+    from gitdb import IStream
+    entries = {}
+    if tree_binsha is not None:
+        for binsha, mode, name in tree_entries_from_data(odb.stream(tree_binsha).read()):
+            entries[name] = (binsha, mode)
+
+    subtree_changes = {}
+    for path, blob in changes.items():
+        if len(path) == 1:
+            entries[path[0]] = blob
+        else:
+            subtree_changes.setdefault(path[0], {})[path[1:]] = blob
+
+    for name, name_changes in subtree_changes.items():
+        subtree = entries.get(name)
+        subtree_binsha = subtree[0] if subtree and stat.S_ISDIR(subtree[1]) else None
+        entries[name] = (write_tree_with_changes(odb, subtree_binsha, name_changes), 0o40000)
+
+    # Git orders tree entries as if the names of subtrees ended with a slash.
+    sorted_entries = sorted(
+        ((binsha, mode, name) for name, (binsha, mode) in entries.items()),
+        key=lambda entry: entry[2] + ('/' if stat.S_ISDIR(entry[1]) else '')
+    )
+    tree_data = io.BytesIO()
+    tree_to_stream(sorted_entries, tree_data.write)
+    tree_data.seek(0)
+    return odb.store(IStream('tree', len(tree_data.getvalue()), tree_data)).binsha
+
+def cpu_count():
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+def monotonic_time():
+    # time.monotonic only exists on Python 3.
+    clock = getattr(time, 'monotonic', time.time)
+    return clock()
+
+class ReleaseTrace:
+    # Records the time spent in each stage of a release together with the
+    # number of subprocesses started, bytes written and git objects created
+    # while it ran.
+    COUNTERS = ('subprocesses', 'bytes_written', 'git_objects')
+
+    def __init__(self, profile_dir=None):
+        # When set, each stage is profiled with cProfile and the stats are
+        # written to this directory.
+        self.profile_dir = profile_dir
+        self.stages = []
+        self.counters = dict((counter, 0) for counter in self.COUNTERS)
+        self._started = monotonic_time()
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+    def count_subprocesses(self):
+        # GitPython imports Popen into its own namespace so it is wrapped
+        # there as well as in subprocess.
+        import git.cmd
+        trace = self
+
+        class CountingPopen(subprocess.Popen):
+            def __init__(self, *args, **kwargs):
+                trace.count('subprocesses')
+                super(CountingPopen, self).__init__(*args, **kwargs)
+
+        subprocess.Popen = CountingPopen
+        git.cmd.Popen = CountingPopen
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        counters = dict(self.counters)
+        profile = None
+        if self.profile_dir:
+            import cProfile
+            profile = cProfile.Profile()
+            profile.enable()
+        start = monotonic_time()
+        try:
+            yield
+        finally:
+            duration = monotonic_time() - start
+            stage = {
+                'name': name,
+                'start': start - self._started,
+                'duration': duration
+            }
+            for counter in self.COUNTERS:
+                stage[counter] = self.counters[counter] - counters[counter]
+            self.stages.append(stage)
+            if profile is not None:
+                profile.disable()
+                if not os.path.isdir(self.profile_dir):
+                    os.makedirs(self.profile_dir)
+                profile.dump_stats(os.path.join(
+                    self.profile_dir,
+                    '{:02d}-{}.prof'.format(len(self.stages), name)
+                ))
+
+    def to_json(self):
+        return {
+            'stages': self.stages,
+            'duration': monotonic_time() - self._started,
+            'totals': self.counters
+        }
+
+    def to_chrome_trace(self):
+        # The Trace Event Format read by chrome://tracing and Perfetto.
+        # Times are in microseconds.
+        events = []
+        for stage in self.stages:
+            events.append({
+                'name': stage['name'],
+                'ph': 'X',
+                'ts': int(stage['start'] * 1000000),
+                'dur': int(stage['duration'] * 1000000),
+                'pid': os.getpid(),
+                'tid': 0,
+                'args': dict((counter, stage[counter]) for counter in self.COUNTERS)
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path, trace_format=TRACE_FORMAT_JSON):
+        if trace_format == TRACE_FORMAT_CHROME:
+            content = self.to_chrome_trace()
+        else:
+            content = self.to_json()
+        with open(path, 'w') as trace_file:
+            json.dump(content, trace_file, indent=2, sort_keys=True)
+
+class ReleaseJournal:
+    # The progress of a release: its versions, the stages it completed and
+    # the repository state after each of them.  It is rewritten atomically
+    # after every stage.  A journal without a path records nothing.
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+
+    @classmethod
+    def read(cls, path):
+        try:
+            with open(path) as journal_file:
+                return cls(path, json.load(journal_file))
+        except IOError:
+            return None
+
+    def is_done(self, stage):
+        return stage in self.state['stages']
+
+    def complete(self, stage, **values):
+        self.state.update(values)
+        self.state['stages'].append(stage)
+        if self.path is None:
+            return
+        journal_file = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.path), delete=False)
+        with journal_file:
+            json.dump(self.state, journal_file, indent=2, sort_keys=True)
+        os.rename(journal_file.name, self.path)
+
+    def remove(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def crate_versions(self):
+        import semantic_version
+        return [
+            (
+                Crate(crate['name'], crate['cargo_file'], crate['version_file'], crate['readme_file']),
+                semantic_version.Version(crate['version'])
+            )
+            for crate in self.state['crates']
+        ]
+
+class NullSlot:
+    # Stands in for a semaphore when nothing limits concurrency.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+class Crate:
+    # The name of a crate and the files that carry its version.  It holds no
+    # repository state so it can be handed to worker processes.  The
+    # attribute names mirror ReleaseContext so a Crate can be passed to the
+    # functions that read and update those files.
+    def __init__(self, name, cargo_file, version_file, readme_file):
+        self.name = name
+        self.cargo_file = cargo_file
+        # version_file and readme_file are None when the crate has no such file.
+        self.version_file = version_file
+        self.readme_file = readme_file
+
+def read_workspace_members(release_context):
+    import contoml
     with open(release_context.cargo_file) as cargo_file:
-        cargo_content = contoml.loads(cargo_file.read())
-        return (cargo_content['package']['version'], cargo_content['package']['name'])
+        cargo_content = contoml.loads(cargo_file.read()).primitive
+
+    workspace_root = os.path.dirname(release_context.cargo_file)
+    workspace = cargo_content.get('workspace', {})
+    excluded = set(
+        os.path.normpath(os.path.join(workspace_root, pattern))
+        for pattern in workspace.get('exclude', [])
+    )
+
+    members = []
+    # A workspace root that is also a package is released along with its members.
+    if 'package' in cargo_content:
+        members.append(Crate(
+            cargo_content['package']['name'],
+            release_context.cargo_file,
+            release_context.version_file,
+            release_context.readme_file
+        ))
+
+    for pattern in workspace.get('members', []):
+        for member_dir in sorted(glob.glob(os.path.join(workspace_root, pattern))):
+            member_cargo_file = os.path.join(member_dir, 'Cargo.toml')
+            if os.path.normpath(member_dir) in excluded or not os.path.isfile(member_cargo_file):
+                continue
+            members.append(Crate(
+                None,
+                member_cargo_file,
+                existing_file(os.path.join(member_dir, 'src', 'version.txt')),
+                existing_file(os.path.join(member_dir, 'README.md'))
+            ))
+
+    return members
+
+def existing_file(path):
+    return path if os.path.isfile(path) else None
+
+def read_workspace_release_versions(release_context):
+    # Members are released with the version confirm_version would default to,
+    # since prompting for dozens of crates is not practical.
+    import semantic_version
+    crate_versions = []
+    for crate in read_workspace_members(release_context):
+        starting_version, crate.name = read_cargo_file(crate)
+        release_version = to_default_release_version(
+            release_context,
+            semantic_version.Version(starting_version)
+        )
+        crate_versions.append((crate, release_version))
+    return crate_versions
+
+def release_tag(release_context, crate, version):
+    return '{}{}'.format(release_tag_prefix(release_context, crate.name), str(version))
+
+def release_tag_prefix(release_context, crate_name):
+    if release_context.workspace:
+        return '{}-v'.format(crate_name)
+    else:
+        return 'v'
+
+class VersionTagIndex:
+    # The release tags of a repository parsed into versions.  The index is
+    # cached in the git directory together with the state of packed-refs,
+    # so only tags added since the last release are parsed again.
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        # The prefix and version of every release tag, by tag name.
+        self.tags = {}
+        self._sorted_versions = {}
+        self.refresh()
+
+    def refresh(self):
+        cache_path = os.path.join(self.git_dir, TAG_INDEX_FILE)
+        try:
+            with open(cache_path) as cache_file:
+                cache = json.load(cache_file)
+        except (IOError, ValueError):
+            cache = {}
+
+        packed_refs_path = os.path.join(self.git_dir, 'packed-refs')
+        packed_refs_stamp = list(file_stamp(packed_refs_path)) if os.path.exists(packed_refs_path) else None
+        if packed_refs_stamp is not None and cache.get('packed_refs') == packed_refs_stamp:
+            packed_tags = cache['packed_tags']
+        else:
+            packed_tags = read_packed_tags(packed_refs_path)
+
+        # Tags that are not release tags are kept as None so they are not
+        # parsed again either.
+        known_tags = cache.get('tags', {})
+        tags = {}
+        for tag in set(packed_tags) | set(read_loose_tags(self.git_dir)):
+            tags[tag] = known_tags[tag] if tag in known_tags else parse_release_tag(tag)
+
+        if tags != known_tags or packed_refs_stamp != cache.get('packed_refs'):
+            cache = {'packed_refs': packed_refs_stamp, 'packed_tags': packed_tags, 'tags': tags}
+            cache_file = tempfile.NamedTemporaryFile('w', dir=self.git_dir, delete=False)
+            with cache_file:
+                json.dump(cache, cache_file)
+            os.rename(cache_file.name, cache_path)
+
+        self.tags = dict((tag, parsed) for tag, parsed in tags.items() if parsed)
+        self._sorted_versions = {}
+
+    def __contains__(self, tag):
+        return tag in self.tags
+
+    def versions(self, prefix):
+        # The versions tagged with prefix, in ascending order.
+        if prefix not in self._sorted_versions:
+            import semantic_version
+            self._sorted_versions[prefix] = sorted(
+                semantic_version.Version(version)
+                for tag_prefix, version in self.tags.values()
+                if tag_prefix == prefix
+            )
+        return self._sorted_versions[prefix]
+
+    def next_free_patch(self, prefix, version):
+        import semantic_version
+        taken = set(self.versions(prefix))
+        patch = version.patch + 1
+        while semantic_version.Version('{}.{}.{}'.format(version.major, version.minor, patch)) in taken:
+            patch += 1
+        return semantic_version.Version('{}.{}.{}'.format(version.major, version.minor, patch))
+
+    def next_free_minor(self, prefix, version):
+        import semantic_version
+        taken = set(self.versions(prefix))
+        minor = version.minor + 1
+        while semantic_version.Version('{}.{}.0'.format(version.major, minor)) in taken:
+            minor += 1
+        return semantic_version.Version('{}.{}.0'.format(version.major, minor))
+
+class VersionOccurrenceIndex:
+    # Where the versions of packages appear in the tracked files of a
+    # repository: docs, examples, Dockerfiles and member READMEs.  A site is
+    # a version on a line that names one of the packages.  The sites of each
+    # file are cached in the git directory with the file's modification time
+    # and size, so only files changed since the last release are scanned
+    # again.  Every version is indexed, not only the current one, so the
+    # cache stays valid from one release to the next.
+    def __init__(self, work_dir, git_dir, names, jobs=1):
+        self.work_dir = work_dir
+        self.cache_path = os.path.join(git_dir, VERSION_INDEX_FILE)
+        self.names = sorted(names)
+        self.jobs = jobs
+        # The stamp and sites of each file, by path relative to work_dir.
+        self.files = {}
+        self.refresh()
+
+    def refresh(self):
+        try:
+            with open(self.cache_path) as cache_file:
+                cache = json.load(cache_file)
+        except (IOError, ValueError):
+            cache = {}
+        known_files = cache.get('files', {}) if cache.get('names') == self.names else {}
+
+        tracked = subprocess.check_output(['git', 'ls-files', '-z'], cwd=self.work_dir).split('\0')
+        self.files = {}
+        stale = []
+        for path in tracked:
+            full_path = os.path.join(self.work_dir, path)
+            if not path or not os.path.isfile(full_path):
+                continue
+            known = known_files.get(path)
+            if known is not None and known['stamp'] == list(file_stamp(full_path)):
+                self.files[path] = known
+            else:
+                stale.append(path)
+
+        work = [(os.path.join(self.work_dir, path), self.names) for path in stale]
+        if self.jobs > 1 and len(work) > VERSION_INDEX_PARALLEL_FILES:
+            import multiprocessing
+            pool = multiprocessing.Pool(self.jobs)
+            try:
+                scanned = pool.map(scan_version_file, work, chunksize=64)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            scanned = [scan_version_file(item) for item in work]
+        for path, entry in zip(stale, scanned):
+            self.files[path] = entry
+
+        if stale or len(self.files) != len(known_files):
+            self.save()
+
+    def rescan(self, path):
+        self.files[path] = scan_version_file((os.path.join(self.work_dir, path), self.names))
+
+    def save(self):
+        cache_file = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.cache_path), delete=False)
+        with cache_file:
+            json.dump({'names': self.names, 'files': self.files}, cache_file)
+        os.rename(cache_file.name, self.cache_path)
+
+    def sites(self, name, version):
+        # The offsets of version on lines naming name, by path.
+        sites = {}
+        for path, entry in self.files.items():
+            offsets = [
+                offset for offset, site_version, site_names in entry['sites']
+                if site_version == version and name in site_names
+            ]
+            if offsets:
+                sites[path] = offsets
+        return sites
+
+    def paths(self, names):
+        # The files with a site on a line naming any of names.
+        return sorted(
+            path for path, entry in self.files.items()
+            if any(set(site_names) & set(names) for _, _, site_names in entry['sites'])
+        )
+
+def scan_version_file(path_names):
+    # Returns the index entry of a file.  Binary files have no sites.
+    path, names = path_names
+    stamp = list(file_stamp(path))
+    with open(path, 'rb') as scanned_file:
+        head = scanned_file.read(8000)
+        if '\0' in head:
+            return {'stamp': stamp, 'sites': []}
+        scanned_file.seek(0)
+        return {'stamp': stamp, 'sites': scan_version_sites(scanned_file, names)}
+
+def scan_version_sites(lines, names):
+    # Returns [offset, version, names] for every version on a line naming
+    # one of names.  A name followed by - or a letter does not match, so vors
+    # does not match vors-derive, but VORS_VERSION does.
+    name_regexes = [(name, version_name_regex(name)) for name in names]
+    sites = []
+    offset = 0
+    for line in lines:
+        line_names = [name for name, regex in name_regexes if regex.search(line)]
+        if line_names:
+            for version_match in VERSION_OCCURRENCE_REGEX.finditer(line):
+                sites.append([offset + version_match.start(), version_match.group(0), line_names])
+        offset += len(line)
+    return sites
+
+_version_name_regexes = {}
+
+def version_name_regex(name):
+    if name not in _version_name_regexes:
+        _version_name_regexes[name] = re.compile(
+            r'(?<![A-Za-z0-9-]){}(?![A-Za-z0-9-])'.format(re.escape(name)), re.IGNORECASE
+        )
+    return _version_name_regexes[name]
+
+def update_version_occurrences(release_context, versions):
+    # versions maps a package name to its (old, new) version.  Every site of
+    # an old version in the tracked files is rewritten, one pass per file.
+    index = release_context.version_occurrence_index(versions.keys())
+    patches = {}
+    for name, (old_version, new_version) in versions.items():
+        for path, offsets in index.sites(name, old_version).items():
+            patches.setdefault(path, set()).update(
+                (offset, offset + len(old_version), new_version) for offset in offsets
+            )
+
+    for path, file_patches in sorted(patches.items()):
+        full_path = os.path.join(index.work_dir, path)
+        patch_file_ranges(full_path, sorted(file_patches))
+        release_context.mark_changed(full_path)
+        release_context.trace.count('bytes_written', os.path.getsize(full_path))
+        index.rescan(path)
+        print 'Updated {} occurrences of the version in {}.'.format(len(file_patches), path)
+    if patches:
+        index.save()
+
+def rewrite_version_occurrences(content, versions):
+    # update_version_occurrences for content held in memory.
+    patches = set()
+    for offset, version, site_names in scan_version_sites(io.BytesIO(content), versions.keys()):
+        for name in site_names:
+            old_version, new_version = versions[name]
+            if version == old_version:
+                patches.add((offset, offset + len(old_version), new_version))
+    for start, end, replacement in sorted(patches, reverse=True):
+        content = content[:start] + replacement + content[end:]
+    return content
+
+def read_packed_tags(packed_refs_path):
+    tags = []
+    if not os.path.exists(packed_refs_path):
+        return tags
+    with open(packed_refs_path) as packed_refs:
+        for line in packed_refs:
+            # Skip the header and the peeled commits of annotated tags.
+            if line.startswith('#') or line.startswith('^'):
+                continue
+            ref = line.rstrip('\n').split(' ', 1)[-1]
+            if ref.startswith('refs/tags/'):
+                tags.append(ref[len('refs/tags/'):])
+    return tags
+
+def read_loose_tags(git_dir):
+    tags_dir = os.path.join(git_dir, 'refs', 'tags')
+    tags = []
+    for directory, _, names in os.walk(tags_dir):
+        for name in names:
+            tags.append(os.path.relpath(os.path.join(directory, name), tags_dir).replace(os.sep, '/'))
+    return tags
+
+def parse_release_tag(tag):
+    import semantic_version
+    match = RELEASE_TAG_REGEX.match(tag)
+    if match and semantic_version.validate(match.group(2)):
+        return [match.group(1), match.group(2)]
+    return None
+
+def to_free_starting_version(release_context, tag_index, prefix, version):
+    # Moves version on to the next patch while its release would reuse an
+    # existing tag.  Snapshot releases are timestamped so they are left alone.
+    if release_context.is_snapshot_release():
+        return version
+    while '{}{}'.format(prefix, to_default_release_version(release_context, version)) in tag_index:
+        version = to_next_patch_snapshot_version(version)
+    return version
+
+def describe_crates(crate_versions):
+    return ', '.join(crate.name for crate, _ in crate_versions)
+
+def describe_versions(crate_versions):
+    if len(crate_versions) == 1:
+        return str(crate_versions[0][1])
+    return ', '.join('{} {}'.format(crate.name, str(version)) for crate, version in crate_versions)
+
+def read_cargo_file(release_context):
+    manifest = read_cargo_manifest(release_context.cargo_file)
+    return (manifest.version, manifest.name)
+
+class CargoManifest:
+    # The [package] name and version of a Cargo.toml together with the byte
+    # span of the version string, found in a single scan.  content is
+    # scanned instead of the file when it is given.
+    def __init__(self, path, content=None):
+        self.path = path
+        self.name = None
+        self.version = None
+        self.version_span = None
+        self.stamp = file_stamp(path) if content is None else None
+
+        table = None
+        offset = 0
+        with open(path, 'rb') if content is None else io.BytesIO(content) as cargo_file:
+            for line in cargo_file:
+                table_match = CARGO_TABLE_REGEX.match(line)
+                if table_match:
+                    table = table_match.group(1)
+                elif table == 'package':
+                    name_match = CARGO_NAME_REGEX.match(line)
+                    version_match = CARGO_VERSION_REGEX.match(line)
+                    if name_match:
+                        self.name = name_match.group(2)
+                    elif version_match:
+                        self.version = version_match.group(2)
+                        start = offset + version_match.end(1)
+                        self.version_span = (start, start + len(self.version))
+                offset += len(line)
+
+        if self.version_span is None:
+            raise ValueError('{} has no [package] version.'.format(path))
+
+# Manifests already scanned, by path.  An entry is only used while the file
+# has the same modification time and size as when it was scanned.
+_cargo_manifests = {}
+
+def file_stamp(path):
+    file_stat = os.stat(path)
+    return (file_stat.st_mtime, file_stat.st_size)
+
+def read_cargo_manifest(path):
+    manifest = _cargo_manifests.get(path)
+    if manifest is None or manifest.stamp != file_stamp(path):
+        manifest = CargoManifest(path)
+        _cargo_manifests[path] = manifest
+    return manifest
 
 def confirm_version(release_context, current_version):
     confirmed_version = None
@@ -192,6 +1718,23 @@ def confirm_version(release_context, current_version):
         if confirmed_version == None:
             print '{} does not fit the semantic versioning spec or is not valid given the specified release type of {}.'.format(input_version, release_context.release_type)
 
+    return to_release_version(release_context, confirmed_version)
+
+def to_default_release_version(release_context, current_version):
+    # The release version confirm_version returns when the user accepts the
+    # version it offers.
+    return to_release_version(release_context, to_presentation_version(release_context, current_version))
+
+def to_proposed_release_version(release_context):
+    # The release version for the version given up front rather than
+    # confirmed by the user.
+    proposed_version = is_valid_proposed_version(release_context, release_context.version)
+    if proposed_version == None:
+        print '{} does not fit the semantic versioning spec or is not valid given the specified release type of {}.'.format(release_context.version, release_context.release_type)
+        sys.exit(1)
+    return to_release_version(release_context, proposed_version)
+
+def to_release_version(release_context, confirmed_version):
     if release_context.is_snapshot_release():
         return to_snapshot_release_version(confirmed_version)
     elif release_context.is_test_final_release():
@@ -206,6 +1749,7 @@ def to_presentation_version(release_context, version):
         return to_final_release_version(version)
 
 def is_valid_proposed_version(release_context, proposed_version):
+    import semantic_version
     validations = []
     sv = None
     if semantic_version.validate(proposed_version):
@@ -226,6 +1770,7 @@ def is_valid_proposed_version(release_context, proposed_version):
         None
 
 def to_next_patch_snapshot_version(original_version):
+    import semantic_version
     return semantic_version.Version(
         '{}.{}.{}-{}'.format(
             original_version.major,
@@ -236,6 +1781,7 @@ def to_next_patch_snapshot_version(original_version):
     )
 
 def to_snapshot_version(original_version):
+    import semantic_version
     return semantic_version.Version(
         '{}.{}.{}-{}'.format(
             original_version.major,
@@ -246,6 +1792,7 @@ def to_snapshot_version(original_version):
     )
 
 def to_snapshot_release_version(original_version, now=datetime.datetime.now()):
+    import semantic_version
     return semantic_version.Version(
         '{}.{}.{}-{}'.format(
             original_version.major,
@@ -256,6 +1803,7 @@ def to_snapshot_release_version(original_version, now=datetime.datetime.now()):
     )
 
 def to_test_final_release_version(original_version):
+    import semantic_version
     return semantic_version.Version(
         '{}.{}.{}-{}'.format(
             original_version.major,
@@ -266,6 +1814,7 @@ def to_test_final_release_version(original_version):
     )
 
 def to_final_release_version(original_version):
+    import semantic_version
     return semantic_version.Version(
         '{}.{}.{}'.format(
             original_version.major,
@@ -274,46 +1823,1245 @@ def to_final_release_version(original_version):
         )
     )
 
+class VersionColumns:
+    # Many versions held column-wise: major, minor and patch in integer
+    # arrays, and the prerelease and build of each as an id into a table of
+    # interned strings, where 0 means none.  The transitions below are the
+    # to_*_version functions applied to whole columns.  They copy arrays
+    # rather than formatting and parsing a Version per row, and work out
+    # anything that depends on a prerelease once per distinct prerelease.
+    # Versions are converted back with to_versions or to_strings only at
+    # the edges.
+    def __init__(self, majors, minors, patches, prereleases, builds, valid, strings=None):
+        from array import array
+        self.majors = majors
+        self.minors = minors
+        self.patches = patches
+        self.prereleases = prereleases
+        self.builds = builds
+        # 1 for the rows that hold a valid semantic version.
+        self.valid = valid
+        # The interned strings and their ids, shared with the columns derived
+        # from these ones.
+        self.strings = strings or ([None], {None: 0})
+
+    @classmethod
+    def from_strings(cls, version_strings):
+        # Rows that are not valid semantic versions, by the rules of
+        # semantic_version, are kept with valid set to 0.
+        from array import array
+        columns = cls(array('L'), array('L'), array('L'), array('l'), array('l'), array('b'))
+        for version_string in version_strings:
+            version_match = VERSION_COLUMNS_REGEX.match(version_string)
+            numbers = version_match.group(1, 2, 3) if version_match else ()
+            if not version_match or any(len(n) > 1 and n[0] == '0' for n in numbers):
+                columns._append(0, 0, 0, 0, 0, 0)
+                continue
+            columns._append(
+                int(numbers[0]), int(numbers[1]), int(numbers[2]),
+                columns._intern(version_match.group(4)),
+                columns._intern(version_match.group(5)),
+                1
+            )
+
+        # Identifiers are checked once per distinct string.  Numeric
+        # prerelease identifiers may not have leading zeros, build ones may.
+        bad_prereleases = columns._ids_with_bad_identifiers(False)
+        bad_builds = columns._ids_with_bad_identifiers(True)
+        if bad_prereleases or bad_builds:
+            for row in range(len(columns)):
+                if columns.prereleases[row] in bad_prereleases or columns.builds[row] in bad_builds:
+                    columns.valid[row] = 0
+        return columns
+
+    @classmethod
+    def from_versions(cls, versions):
+        from array import array
+        columns = cls(array('L'), array('L'), array('L'), array('l'), array('l'), array('b'))
+        for version in versions:
+            columns._append(
+                version.major, version.minor, version.patch,
+                columns._intern('.'.join(version.prerelease) or None),
+                columns._intern('.'.join(version.build) or None),
+                1
+            )
+        return columns
+
+    def __len__(self):
+        return len(self.majors)
+
+    def _append(self, major, minor, patch, prerelease, build, valid):
+        self.majors.append(major)
+        self.minors.append(minor)
+        self.patches.append(patch)
+        self.prereleases.append(prerelease)
+        self.builds.append(build)
+        self.valid.append(valid)
+
+    def _intern(self, value):
+        strings, ids = self.strings
+        if value not in ids:
+            ids[value] = len(strings)
+            strings.append(value)
+        return ids[value]
+
+    def _ids_with_bad_identifiers(self, allow_leading_zeroes):
+        return set(
+            string_id for string_id, value in enumerate(self.strings[0])
+            if value is not None and any(
+                not item or (item[0] == '0' and item.isdigit() and item != '0' and not allow_leading_zeroes)
+                for item in value.split('.')
+            )
+        )
+
+    def _with_prerelease(self, prerelease, patch_increment=0):
+        from array import array
+        rows = len(self)
+        if patch_increment:
+            patches = array('L', (patch + patch_increment for patch in self.patches))
+        else:
+            patches = array('L', self.patches)
+        return VersionColumns(
+            array('L', self.majors),
+            array('L', self.minors),
+            patches,
+            array('l', [self._intern(prerelease)]) * rows,
+            array('l', [0]) * rows,
+            array('b', self.valid),
+            self.strings
+        )
+
+    def to_snapshot(self):
+        return self._with_prerelease(SNAPSHOT)
+
+    def to_next_patch_snapshot(self):
+        return self._with_prerelease(SNAPSHOT, 1)
+
+    def to_snapshot_release(self, now=None):
+        return self._with_prerelease((now or datetime.datetime.now()).strftime('%Y%m%d%H%M%S'))
+
+    def to_test_final_release(self):
+        return self._with_prerelease('TESTFINALRELEASE')
+
+    def to_final_release(self):
+        return self._with_prerelease(None)
+
+    def to_presentation(self, release_type):
+        if release_type == RELEASE_TYPE_SNAPSHOT:
+            return self.to_snapshot()
+        return self.to_final_release()
+
+    def to_release(self, release_type, now=None):
+        if release_type == RELEASE_TYPE_SNAPSHOT:
+            return self.to_snapshot_release(now)
+        elif release_type == RELEASE_TYPE_TEST_FINAL:
+            return self.to_test_final_release()
+        return self
+
+    def valid_proposed(self, release_type):
+        # is_valid_proposed_version for every row: 1 where the version may
+        # be proposed for a release of release_type.
+        from array import array
+        if release_type == RELEASE_TYPE_SNAPSHOT:
+            allowed = set(
+                string_id for string_id, value in enumerate(self.strings[0])
+                if value is not None and value.split('.')[0].upper() == SNAPSHOT
+            )
+        else:
+            allowed = set([0])
+        return array('b', (
+            1 if valid and prerelease in allowed else 0
+            for valid, prerelease in zip(self.valid, self.prereleases)
+        ))
+
+    def to_strings(self):
+        # None for the rows that are not valid versions.
+        strings = self.strings[0]
+        version_strings = []
+        for row in range(len(self)):
+            if not self.valid[row]:
+                version_strings.append(None)
+                continue
+            version_string = '{}.{}.{}'.format(self.majors[row], self.minors[row], self.patches[row])
+            if self.prereleases[row]:
+                version_string += '-' + strings[self.prereleases[row]]
+            if self.builds[row]:
+                version_string += '+' + strings[self.builds[row]]
+            version_strings.append(version_string)
+        return version_strings
+
+    def to_versions(self):
+        import semantic_version
+        return [
+            semantic_version.Version(version_string) if version_string is not None else None
+            for version_string in self.to_strings()
+        ]
+
+
+def update_crates_version_in_files(release_context, crate_versions):
+    for crate, _ in crate_versions:
+        release_context.mark_changed(crate.cargo_file, crate.version_file, crate.readme_file)
+
+    # The versions being replaced identify the entries to patch in Cargo.lock.
+    lock_versions = {}
+    for crate, version in crate_versions:
+        lock_versions[crate.name] = (read_cargo_file(crate)[0], str(version))
+
+    # Versions are passed as strings so the work items pickle cleanly.
+    work = [(crate, str(version)) for crate, version in crate_versions]
+    if release_context.jobs > 1 and len(work) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(release_context.jobs, len(work)))
+        try:
+            bytes_written = pool.map(update_crate_version_in_files, work)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        bytes_written = [update_crate_version_in_files(item) for item in work]
+    release_context.trace.count('bytes_written', sum(bytes_written))
+
+    cargo_lock_file = os.path.join(os.path.dirname(release_context.cargo_file), CARGO_LOCK_FILE)
+    if os.path.exists(cargo_lock_file) and update_cargo_lock_versions(cargo_lock_file, lock_versions):
+        release_context.trace.count('bytes_written', os.path.getsize(cargo_lock_file))
+        # Libraries usually leave Cargo.lock out of the repository.
+        release_context.mark_changed_if_tracked(cargo_lock_file)
+        print 'Updated {} with the release version.'.format(cargo_lock_file)
+
+    # Runs last so the sites the files above already rewrote are not found.
+    if release_context.update_occurrences:
+        update_version_occurrences(release_context, lock_versions)
+
+def update_crate_version_in_files(crate_version):
+    crate, version = crate_version
+    return update_version_in_files(crate, version, crate.name)
+
 def update_version_in_files(release_context, version, package_name):
+    # Returns the number of bytes written to the files that changed.
+    bytes_written = 0
     version_string = str(version)
-    update_cargo_file_version(release_context, version_string)
+    if update_cargo_file_version(release_context, version_string):
+        bytes_written += os.path.getsize(release_context.cargo_file)
     print 'Updated {} with the release version.'.format(release_context.cargo_file)
 
-    update_version_file(release_context, version_string)
-    print 'Updated {} with the release version.'.format(release_context.version_file)
+    if release_context.version_file:
+        if update_version_file(release_context, version_string):
+            bytes_written += os.path.getsize(release_context.version_file)
+        print 'Updated {} with the release version.'.format(release_context.version_file)
 
-    update_readme_file_version(release_context, package_name, version_string)
-    print 'Updated {} with the release version.'.format(release_context.readme_file)
+    if release_context.readme_file:
+        if update_readme_file_version(release_context, package_name, version_string):
+            bytes_written += os.path.getsize(release_context.readme_file)
+        print 'Updated {} with the release version.'.format(release_context.readme_file)
+
+    return bytes_written
+
+# Each update function returns the (start, end) byte ranges of the original
+# file that were rewritten.
 
 def update_cargo_file_version(release_context, version):
-    with open(release_context.cargo_file, 'r+') as cargo_file:
-        cargo_content = contoml.loads(cargo_file.read())
-        cargo_content['package']['version'] = version
-        cargo_content.dump(release_context.cargo_file)
+    # Only the bytes of the [package] version string are replaced, at the
+    # span found when the manifest was read.
+    manifest = read_cargo_manifest(release_context.cargo_file)
+    if manifest.version == version:
+        return []
+
+    start, end = manifest.version_span
+    patch_file(manifest.path, start, end, version)
+    manifest.version = version
+    manifest.version_span = (start, start + len(version))
+    manifest.stamp = file_stamp(manifest.path)
+    return [(start, end)]
+
+def update_cargo_lock_versions(cargo_lock_file, lock_versions):
+    # lock_versions maps a package name to its (old, new) version.  Only the
+    # [[package]] entries with that name and old version are updated, so
+    # cargo does not have to resolve the lock file again.
+    return rewrite_file(cargo_lock_file, CargoLockRewriter(lock_versions))
 
 def update_version_file(release_context, version):
-    with open(release_context.version_file, 'w') as version_file:
-        version_file.write(version)
+    return rewrite_file(release_context.version_file, ReplaceContentRewriter(version))
 
 def update_readme_file_version(release_context, package_name, version):
-    final_readme_version = '{} = {}\n'.format(package_name, version)
-    readme_version_regex = re.compile('{}\s*=\s*\d.\d.\d.*\n'.format(package_name))
-    final_readme_content = ''
-    with open(release_context.readme_file, 'r') as readme_file:
-        final_readme_content = readme_version_regex.sub(final_readme_version, readme_file.read())
+    return rewrite_file(release_context.readme_file, ReadmeVersionRewriter(package_name, version))
+
+class CargoLockRewriter:
+    # Rewrites the version of matching [[package]] entries.  Cargo writes the
+    # name of an entry before its version.
+    def __init__(self, lock_versions):
+        self.lock_versions = lock_versions
+        self.name = None
+
+    def __call__(self, line):
+        if CARGO_TABLE_REGEX.match(line):
+            self.name = None
+            return line
+
+        name_match = CARGO_NAME_REGEX.match(line)
+        if name_match:
+            self.name = name_match.group(2)
+            return line
+
+        version_match = CARGO_VERSION_REGEX.match(line)
+        if version_match and self.name in self.lock_versions:
+            old_version, new_version = self.lock_versions[self.name]
+            if version_match.group(2) == old_version:
+                return '{}{}{}'.format(line[:version_match.start(2)], new_version, line[version_match.end(2):])
+        return line
+
+class ReadmeVersionRewriter:
+    # Rewrites lines such as `vors = 1.0.0` that document the dependency on
+    # the package.
+    _regexes = {}
+
+    def __init__(self, package_name, version):
+        self.replacement = '{} = {}\n'.format(package_name, version)
+        if package_name not in self._regexes:
+            self._regexes[package_name] = re.compile(
+                r'{}\s*=\s*\d+\.\d+\.\d+.*\n'.format(re.escape(package_name))
+            )
+        self.regex = self._regexes[package_name]
+
+    def __call__(self, line):
+        return self.regex.sub(self.replacement, line)
 
-    with open(release_context.readme_file, 'w') as readme_file:
-        readme_file.write(final_readme_content)
+class ReplaceContentRewriter:
+    # Replaces the whole file with content.
+    def __init__(self, content):
+        self.content = content
+        self.written = False
 
-def attempt_build():
+    def __call__(self, line):
+        if self.written:
+            return ''
+        self.written = True
+        return self.content
+
+    def finish(self):
+        # Called once the input is exhausted so an empty file still gets the
+        # content.
+        return '' if self.written else self.__call__('')
+
+def rewrite_file(path, rewrite_line):
+    # Streams path line by line through rewrite_line into a temporary file
+    # next to it, then renames the temporary file over path.  Memory use does
+    # not depend on the size of the file, and a crash part way through leaves
+    # path as it was.  The file is left alone when nothing changed.
+    changed_ranges = []
+    offset = 0
+    directory = os.path.dirname(os.path.abspath(path))
+    rewritten_file = tempfile.NamedTemporaryFile('wb', dir=directory, prefix='.vors-', delete=False)
+    try:
+        # A missing file is treated as empty so rewriters can create it.
+        exists = os.path.exists(path)
+        with (open(path, 'rb') if exists else io.BytesIO()) as original_file, rewritten_file:
+            for line in original_file:
+                rewritten_line = rewrite_line(line)
+                if rewritten_line != line:
+                    add_changed_range(changed_ranges, offset, offset + len(line))
+                rewritten_file.write(rewritten_line)
+                offset += len(line)
+            if hasattr(rewrite_line, 'finish'):
+                trailer = rewrite_line.finish()
+                if trailer:
+                    add_changed_range(changed_ranges, offset, offset)
+                    rewritten_file.write(trailer)
+
+        if changed_ranges:
+            if exists:
+                shutil.copymode(path, rewritten_file.name)
+            else:
+                os.chmod(rewritten_file.name, 0o644)
+            os.rename(rewritten_file.name, path)
+    finally:
+        if os.path.exists(rewritten_file.name):
+            os.remove(rewritten_file.name)
+
+    return changed_ranges
+
+def patch_file(path, start, end, replacement):
+    # Replaces the bytes from start to end of path.
+    patch_file_ranges(path, [(start, end, replacement)])
+
+def patch_file_ranges(path, patches):
+    # Replaces each (start, end, replacement) of patches, which are sorted
+    # and do not overlap.  The rest of the file is copied without being
+    # parsed into a temporary file that is renamed over path.
+    directory = os.path.dirname(os.path.abspath(path))
+    patched_file = tempfile.NamedTemporaryFile('wb', dir=directory, prefix='.vors-', delete=False)
     try:
-        retcode = subprocess.call(BUILD_CMD, shell=True)
-        if retcode == 0:
+        with open(path, 'rb') as original_file, patched_file:
+            offset = 0
+            for start, end, replacement in patches:
+                patched_file.write(original_file.read(start - offset))
+                patched_file.write(replacement)
+                original_file.seek(end)
+                offset = end
+            shutil.copyfileobj(original_file, patched_file)
+        shutil.copymode(path, patched_file.name)
+        os.rename(patched_file.name, path)
+    finally:
+        if os.path.exists(patched_file.name):
+            os.remove(patched_file.name)
+
+def add_changed_range(changed_ranges, start, end):
+    if changed_ranges and changed_ranges[-1][1] == start:
+        changed_ranges[-1] = (changed_ranges[-1][0], end)
+    else:
+        changed_ranges.append((start, end))
+
+class BuildCache:
+    # Build results keyed by the content that was built.  Each entry is a
+    # small JSON file recording the build result and the checksums of the
+    # artifacts it produced.
+    def __init__(self, cache_dir, max_age=BUILD_CACHE_MAX_AGE, max_bytes=BUILD_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+    def key(self, tree_hash, toolchain_version, build_cmd):
+        key_hash = hashlib.sha1()
+        for part in (tree_hash, toolchain_version, build_cmd):
+            key_hash.update(part.encode('utf-8'))
+            key_hash.update(b'\0')
+        return key_hash.hexdigest()
+
+    def lookup(self, key, artifact_dir=BUILD_ARTIFACT_DIR):
+        try:
+            with open(self._entry_path(key)) as entry_file:
+                entry = json.load(entry_file)
+        except (IOError, ValueError):
+            return None
+
+        if time.time() - entry['created'] > self.max_age:
+            return None
+
+        # A successful build is only reused while its artifacts are still in
+        # place, otherwise later steps would run without them.
+        if entry['result'] == 0:
+            artifacts = checksum_artifacts(artifact_dir)
+            for path, checksum in entry['artifacts'].items():
+                if artifacts.get(path) != checksum:
+                    return None
+
+        return entry
+
+    def store(self, key, build_result, artifacts):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        entry = {
+            'result': build_result,
+            'artifacts': artifacts,
+            'created': time.time()
+        }
+        entry_file = tempfile.NamedTemporaryFile('w', dir=self.cache_dir, delete=False)
+        with entry_file:
+            json.dump(entry, entry_file)
+        os.rename(entry_file.name, self._entry_path(key))
+
+    def evict(self, now=None):
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        now = now or time.time()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if not name.endswith('.json'):
+                continue
+            stat = os.stat(path)
+            if now - stat.st_mtime > self.max_age:
+                os.remove(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, '{}.json'.format(key))
+
+def checksum_artifacts(artifact_dir):
+    artifacts = {}
+    if not os.path.isdir(artifact_dir):
+        return artifacts
+
+    for name in sorted(os.listdir(artifact_dir)):
+        path = os.path.join(artifact_dir, name)
+        if not os.path.isfile(path):
+            continue
+        checksum = hashlib.sha1()
+        with open(path, 'rb') as artifact:
+            for chunk in iter(lambda: artifact.read(1024 * 1024), b''):
+                checksum.update(chunk)
+        artifacts[name] = checksum.hexdigest()
+    return artifacts
+
+def read_toolchain_version(cwd=None):
+    # The toolchain can be pinned per repository so it is read from cwd.
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(TOOLCHAIN_VERSION_CMD, shell=True, cwd=cwd, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def attempt_release_build(release_context, build_dir=None):
+    if release_context.checks:
+        return run_release_checks(release_context, build_dir)
+
+    env = None
+    if build_dir is not None and 'CARGO_TARGET_DIR' not in os.environ:
+        # A build in another worktree shares the target directory of the
+        # repository, so it is incremental and its artifacts end up where a
+        # normal build would put them.
+        env = dict(os.environ, CARGO_TARGET_DIR=os.path.abspath(os.path.join(release_context.repo_dir, 'target')))
+    return attempt_build(
+        build_dir or release_context.repo_dir,
+        release_context.output,
+        release_context.build_timeout,
+        release_context.build_idle_timeout,
+        release_context.fail_fast,
+        env
+    )
+
+def attempt_cached_build(release_context, build_dir=None, tree_hash=None):
+    # build_dir and tree_hash are the worktree being built and the hash of
+    # its tree, by default the worktree of the repository.
+    if not release_context.build_cache_dir:
+        return attempt_release_build(release_context, build_dir)
+
+    artifact_dir = os.path.join(release_context.repo_dir, BUILD_ARTIFACT_DIR)
+    build_cache = BuildCache(release_context.build_cache_dir)
+    cache_key = build_cache.key(
+        tree_hash or release_context.worktree_tree_hash(),
+        read_toolchain_version(build_dir or release_context.repo_dir),
+        ' && '.join([BUILD_CMD] + [CHECK_CMDS[check] for check in release_context.checks])
+    )
+    release_context.build_cache_key = cache_key
+    entry = build_cache.lookup(cache_key, artifact_dir)
+    if entry is not None:
+        print 'Reusing the cached build result for this tree ({}).'.format(cache_key)
+        return (entry['result'], None)
+
+    build_result, error = attempt_release_build(release_context, build_dir)
+    # An exception says nothing about the tree so it is never cached.
+    if build_result != 2:
+        artifacts = checksum_artifacts(artifact_dir) if build_result == 0 else {}
+        build_cache.store(cache_key, build_result, artifacts)
+        build_cache.evict()
+    return (build_result, error)
+
+class StageGraph:
+    # Runs stages as soon as the stages they depend on have succeeded, up to
+    # max_jobs at a time, each on its own thread.  When a stage fails the
+    # stages still running are cancelled and those not started are skipped.
+    def __init__(self, max_jobs):
+        self.max_jobs = max_jobs
+        # (name, run, cancel, depends_on) in the order they were added.
+        self.stages = []
+
+    def add(self, name, run, cancel=None, depends_on=()):
+        # run returns (0, None) on success, like attempt_build.  cancel is
+        # called from another thread to stop run early.
+        names = [stage[0] for stage in self.stages]
+        if name in names:
+            raise ValueError('There is already a stage named {}.'.format(name))
+        for dependency in depends_on:
+            if dependency not in names:
+                raise ValueError('{} depends on {}, which has not been added.'.format(name, dependency))
+        self.stages.append((name, run, cancel, tuple(depends_on)))
+
+    def run(self):
+        # Returns the (result, error) of every stage by name, in the order
+        # they finished, and the name of the first stage that failed.
+        import Queue
+        finished = Queue.Queue()
+        pending = list(self.stages)
+        running = {}
+        results = []
+        first_failure = None
+
+        def run_stage(name, run):
+            try:
+                finished.put((name, run()))
+            except Exception as e:
+                finished.put((name, (2, e)))
+
+        while pending or running:
+            succeeded = set(name for name, (result, _) in results if result == 0)
+            for stage in list(pending):
+                if first_failure is not None or len(running) >= self.max_jobs:
+                    break
+                name, run, cancel, depends_on = stage
+                if all(dependency in succeeded for dependency in depends_on):
+                    pending.remove(stage)
+                    running[name] = (start_thread(run_stage, name, run), cancel)
+            if not running:
+                break
+
+            name, result = finished.get()
+            running.pop(name)[0].join()
+            results.append((name, result))
+            if result[0] != 0 and first_failure is None:
+                first_failure = name
+                for _, cancel in running.values():
+                    if cancel is not None:
+                        cancel()
+
+        for name, _, _, _ in pending:
+            results.append((name, (1, 'Skipped because {} failed.'.format(first_failure))))
+        return results, first_failure
+
+def run_release_checks(release_context, build_dir=None):
+    # Runs the build and the checks of the release as a stage graph.  The
+    # output of each is written to its own log file.
+    build_dir = build_dir or release_context.repo_dir
+    target_dir = os.environ.get('CARGO_TARGET_DIR') or os.path.abspath(os.path.join(release_context.repo_dir, 'target'))
+    log_dir = os.path.join(target_dir, CHECK_LOG_DIR)
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    graph = StageGraph(release_context.check_jobs)
+    log_files = []
+    try:
+        for name, command in [('build', BUILD_CMD)] + [(check, CHECK_CMDS[check]) for check in release_context.checks]:
+            # cargo locks its target directory for the length of a command,
+            # so each check gets a target directory of its own to run
+            # alongside the build.  The build keeps the usual one so its
+            # artifacts are where they are expected.
+            job_target_dir = target_dir if name == 'build' else os.path.join(target_dir, 'vors-{}'.format(name))
+            log_file = open(os.path.join(log_dir, '{}.log'.format(name)), 'w')
+            log_files.append(log_file)
+            runner = BuildRunner(
+                build_dir,
+                log_file,
+                release_context.build_timeout,
+                release_context.build_idle_timeout,
+                release_context.fail_fast,
+                dict(os.environ, CARGO_TARGET_DIR=job_target_dir),
+                command,
+                name
+            )
+            graph.add(name, runner.run, runner.cancel, CHECK_DEPENDENCIES.get(name, ()))
+        results, first_failure = graph.run()
+    finally:
+        for log_file in log_files:
+            log_file.close()
+
+    for name, (result, _) in results:
+        print '{} {}.'.format(name, 'passed' if result == 0 else 'failed')
+    if first_failure is None:
+        return (0, None)
+    result, error = dict(results)[first_failure]
+    if result == 2:
+        return (2, error)
+    return (1, '{} failed. See {}.\n{}'.format(first_failure, os.path.join(log_dir, first_failure + '.log'), error or ''))
+
+def attempt_build(cwd=None, output=None, timeout=None, idle_timeout=None, fail_fast=False, env=None):
+    return BuildRunner(cwd, output, timeout, idle_timeout, fail_fast, env).run()
+
+def build_command(command=None):
+    # The build command, or command, as arguments, asking cargo for JSON
+    # messages when the cargo subcommand supports them.
+    import shlex
+    args = shlex.split(command or BUILD_CMD)
+    if (os.path.basename(args[0]) == 'cargo' and len(args) > 1 and args[1] in CARGO_JSON_SUBCOMMANDS
+        and not any(a.startswith('--message-format') for a in args)):
+        # Arguments after -- are for the tool cargo runs, not for cargo.
+        args.insert(args.index('--') if '--' in args else len(args), CARGO_MESSAGE_FORMAT)
+    return args
+
+class BuildRunner:
+    # Runs the build, reading its output a line at a time as it arrives.
+    # cargo's JSON messages are turned into per-crate progress and rendered
+    # diagnostics.  Only the last few error diagnostics and output lines are
+    # kept, for the failure message, so a chatty build does not grow memory.
+    # The output is read by a thread so the build can be stopped when it
+    # runs too long, goes quiet for too long or, with fail_fast, reports its
+    # first error.
+    def __init__(self, cwd=None, output=None, timeout=None, idle_timeout=None, fail_fast=False, env=None,
+                 command=None, name=None):
+        import collections
+        self.cwd = cwd
+        # The environment of the build.  None inherits this one.
+        self.env = env
+        # The command run instead of BUILD_CMD, and the name its progress is
+        # reported under.
+        self.command = command
+        self.name = name
+        # The file the build output is written to.  None writes it to stdout.
+        self.output = output
+        # Both timeouts are in seconds.  None waits forever.
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.fail_fast = fail_fast
+        self.errors = collections.deque(maxlen=BUILD_MAX_DIAGNOSTICS)
+        self.tail = collections.deque(maxlen=BUILD_TAIL_LINES)
+        self.crates_built = 0
+        self.process = None
+        self.cancelled = False
+
+    def cancel(self):
+        # Stops the build from another thread.
+        self.cancelled = True
+        if self.process is not None:
+            self._kill(self.process)
+
+    def run(self):
+        # Returns (0, None) when the build succeeds, (1, reason) when it
+        # fails and (2, exception) when it could not be run.
+        import Queue
+        try:
+            # The build runs in its own process group so the compilers cargo
+            # started are stopped with it.
+            process = subprocess.Popen(
+                build_command(self.command),
+                cwd=self.cwd,
+                env=self.env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                preexec_fn=os.setsid
+            )
+        except OSError as e:
+            return (2, e)
+        self.process = process
+        if self.cancelled:
+            self._kill(process)
+
+        lines = Queue.Queue()
+        reader = threading.Thread(target=read_lines, args=(process.stdout, lines))
+        reader.daemon = True
+        reader.start()
+
+        start = last_line = monotonic_time()
+        while True:
+            wait = self._wait(start, last_line)
+            try:
+                line = lines.get(timeout=wait) if wait is None or wait > 0 else lines.get_nowait()
+            except Queue.Empty:
+                self._stop(process)
+                if self.timeout is not None and monotonic_time() - start >= self.timeout:
+                    return (1, 'The build did not finish within {} seconds.'.format(self.timeout))
+                return (1, 'The build printed nothing for {} seconds.'.format(self.idle_timeout))
+            if line is None:
+                break
+            last_line = monotonic_time()
+            if self._handle_line(line) and self.fail_fast:
+                self._stop(process)
+                return (1, self.failure())
+
+        if process.wait() == 0:
             return (0, None)
-        else:
-            return (1, None)
-    except OSError as e:
-        return (2, e)
+        if self.cancelled:
+            return (1, 'Cancelled.')
+        return (1, self.failure())
+
+    def _wait(self, start, last_line):
+        # The seconds until the next timeout, or None.
+        deadlines = []
+        if self.timeout is not None:
+            deadlines.append(start + self.timeout)
+        if self.idle_timeout is not None:
+            deadlines.append(last_line + self.idle_timeout)
+        if not deadlines:
+            return None
+        return min(deadlines) - monotonic_time()
+
+    def _handle_line(self, line):
+        # Returns True when the line reports an error.
+        message = None
+        if line.startswith('{'):
+            try:
+                message = json.loads(line)
+            except ValueError:
+                pass
+        if not isinstance(message, dict):
+            self._write(line)
+            self.tail.append(line)
+            return False
+
+        reason = message.get('reason')
+        if reason == 'compiler-artifact':
+            self.crates_built += 1
+            progress = 'Built {} ({} crates).'.format(message.get('target', {}).get('name'), self.crates_built)
+            print '{}: {}'.format(self.name, progress) if self.name else progress
+        elif reason == 'compiler-message':
+            diagnostic = message.get('message', {})
+            rendered = (diagnostic.get('rendered') or diagnostic.get('message', '')).encode('utf-8')
+            self._write(rendered)
+            if diagnostic.get('level') == 'error':
+                self.errors.append(rendered)
+                return True
+        return False
+
+    def _write(self, text):
+        output = self.output or sys.stdout
+        output.write(text if text.endswith('\n') else text + '\n')
+
+    def _stop(self, process):
+        self._kill(process)
+        process.wait()
+
+    def _kill(self, process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def failure(self):
+        # What the build printed last, errors first.
+        if self.errors:
+            return ''.join(e if e.endswith('\n') else e + '\n' for e in self.errors)
+        return ''.join(self.tail) or None
+
+def read_lines(stream, lines):
+    # Puts every line of stream on the lines queue, then None.
+    for line in iter(stream.readline, ''):
+        lines.put(line)
+    stream.close()
+    lines.put(None)
+
+FLEET_STATUS_PENDING = 'pending'
+FLEET_STATUS_INVALID = 'invalid'
+FLEET_STATUS_RELEASED = 'released'
+FLEET_STATUS_FAILED = 'failed'
+
+class FleetRelease:
+    # One entry of a fleet plan and, once it has run, its outcome.
+    def __init__(self, name, repo_dir, release_type, version=None, cargo_file='Cargo.toml',
+                 version_file='./src/version.txt', readme_file='README.md', workspace=False,
+                 dry_run=False, resume=False):
+        # The name of the release in the summary and of its log file.
+        self.name = name
+        self.repo_dir = repo_dir
+        self.release_type = release_type.lower()
+        self.version = version
+        self.cargo_file = cargo_file
+        self.version_file = version_file
+        self.readme_file = readme_file
+        self.workspace = workspace
+        self.dry_run = dry_run
+        self.resume = resume
+        self.status = FLEET_STATUS_PENDING
+        self.error = None
+        self.tags = []
+        self.duration = None
+        # The name of the release that released this one, when the daemon
+        # coalesced it into another.
+        self.coalesced_into = None
+
+    def to_json(self):
+        return {
+            'name': self.name,
+            'repo': self.repo_dir,
+            'release_type': self.release_type,
+            'version': self.version,
+            'status': self.status,
+            'error': self.error,
+            'tags': self.tags,
+            'duration': self.duration,
+            'coalesced_into': self.coalesced_into
+        }
+
+    def new_release_context(self, build_slot, git_slot, output, build_cache_dir=None, repo=None):
+        return ReleaseContext(
+            self.release_type,
+            os.path.join(self.repo_dir, self.cargo_file),
+            os.path.join(self.repo_dir, self.version_file),
+            os.path.join(self.repo_dir, self.readme_file),
+            False,
+            self.dry_run,
+            workspace=self.workspace,
+            build_cache_dir=build_cache_dir,
+            version=self.version,
+            repo_dir=self.repo_dir,
+            build_slot=build_slot,
+            git_slot=git_slot,
+            output=output,
+            interactive=False,
+            resume=self.resume,
+            repo=repo
+        )
+
+    def run(self, release_context, log_name):
+        # Records the outcome of the release instead of letting it exit.
+        start = monotonic_time()
+        try:
+            self.tags = run_release(release_context)
+            self.status = FLEET_STATUS_RELEASED
+        except SystemExit as e:
+            self.status = FLEET_STATUS_FAILED
+            self.error = 'The release exited with status {}. See {}.'.format(e.code, log_name)
+        except Exception as e:
+            self.status = FLEET_STATUS_FAILED
+            self.error = '{}: {}'.format(type(e).__name__, e)
+        self.duration = monotonic_time() - start
+
+def read_fleet_plan(plan_file):
+    # The plan is a JSON list of objects with a repo and a release_type, and
+    # optionally a name, version, cargo_file, version_file, readme_file and
+    # workspace.  Repository paths are relative to the plan file.
+    # Every entry is checked up front so a bad plan fails before anything
+    # is released.
+    with open(plan_file) as plan:
+        entries = json.load(plan)
+
+    plan_dir = os.path.dirname(os.path.abspath(plan_file))
+    return [read_fleet_release(entry, plan_dir) for entry in entries]
+
+def read_fleet_release(entry, base_dir):
+    # Reads one plan entry or daemon request.  Its repository path is
+    # relative to base_dir.
+    fleet_release = FleetRelease(
+        entry.get('name', entry['repo']),
+        os.path.join(base_dir, entry['repo']),
+        entry['release_type'],
+        version=entry.get('version'),
+        cargo_file=entry.get('cargo_file', 'Cargo.toml'),
+        version_file=entry.get('version_file', './src/version.txt'),
+        readme_file=entry.get('readme_file', 'README.md'),
+        workspace=entry.get('workspace', False),
+        dry_run=entry.get('dry_run', False),
+        resume=entry.get('resume', False)
+    )
+    fleet_release.error = validate_fleet_release(fleet_release)
+    if fleet_release.error:
+        fleet_release.status = FLEET_STATUS_INVALID
+    return fleet_release
+
+def validate_fleet_release(fleet_release):
+    release_context = ReleaseContext(
+        fleet_release.release_type, None, None, None, False, False
+    )
+    if fleet_release.release_type not in (RELEASE_TYPE_SNAPSHOT, RELEASE_TYPE_FINAL, RELEASE_TYPE_TEST_FINAL):
+        return 'The release type must be one of snapshot, final or testfinal.'
+    if not os.path.isdir(fleet_release.repo_dir):
+        return '{} is not a directory.'.format(fleet_release.repo_dir)
+    if fleet_release.version is not None:
+        if fleet_release.workspace:
+            return 'Workspace members are released with their own versions.'
+        if is_valid_proposed_version(release_context, fleet_release.version) == None:
+            return '{} does not fit the semantic versioning spec or is not valid given the specified release type of {}.'.format(fleet_release.version, fleet_release.release_type)
+    return None
+
+class ThreadOutput:
+    # Routes what each thread prints to the stream it registered, and
+    # everything else to the original stream.
+    def __init__(self, default):
+        self.default = default
+        self._local = threading.local()
+
+    def register(self, stream):
+        self._local.stream = stream
+
+    def current(self):
+        return getattr(self._local, 'stream', self.default)
+
+    def write(self, data):
+        self.current().write(data)
+
+    def flush(self):
+        self.current().flush()
+
+class Fleet:
+    # Runs the releases of a plan concurrently.  Builds and git operations
+    # are limited separately, so a few slow builds do not hold up the commits
+    # and pushes of the other releases.
+    # Python 2 has no asyncio, so each release runs on a worker thread and
+    # the limits are semaphores.
+    def __init__(self, max_releases, max_builds, max_git_ops, log_dir, build_cache_dir=None):
+        self.max_releases = max_releases
+        self.build_slot = threading.BoundedSemaphore(max_builds)
+        self.git_slot = threading.BoundedSemaphore(max_git_ops)
+        self.log_dir = log_dir
+        self.build_cache_dir = build_cache_dir
+
+    def run(self, fleet_releases):
+        import Queue
+        pending = Queue.Queue()
+        for fleet_release in fleet_releases:
+            pending.put(fleet_release)
+
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = ThreadOutput(stdout), ThreadOutput(stderr)
+        try:
+            workers = [
+                threading.Thread(target=self._work, args=(pending,))
+                for _ in range(min(self.max_releases, len(fleet_releases)))
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    def _work(self, pending):
+        import Queue
+        while True:
+            try:
+                fleet_release = pending.get_nowait()
+            except Queue.Empty:
+                return
+            self.release(fleet_release)
+
+    def release(self, fleet_release):
+        with open(os.path.join(self.log_dir, fleet_log_name(fleet_release)), 'a') as log:
+            sys.stdout.register(log)
+            sys.stderr.register(log)
+            release_context = fleet_release.new_release_context(
+                self.build_slot, self.git_slot, log, self.build_cache_dir
+            )
+            fleet_release.run(release_context, log.name)
+
+def fleet_log_name(fleet_release):
+    return '{}.log'.format(os.path.normpath(fleet_release.name).replace(os.sep, '_'))
+
+def print_fleet_summary(fleet_releases):
+    for fleet_release in fleet_releases:
+        print '{:<9} {:<9} {} {}'.format(
+            fleet_release.status,
+            fleet_release.release_type,
+            fleet_release.name,
+            ', '.join(fleet_release.tags) or fleet_release.error or ''
+        )
+    released = sum(1 for r in fleet_releases if r.status == FLEET_STATUS_RELEASED)
+    print '{} of {} releases succeeded.'.format(released, len(fleet_releases))
+
+def write_fleet_report(report_file, fleet_releases):
+    with open(report_file, 'w') as report:
+        json.dump([r.to_json() for r in fleet_releases], report, indent=2, sort_keys=True)
+
+class StreamOutput:
+    # Sends what is written to it to a daemon client as output messages.  A
+    # client that went away does not stop the release.
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.connected = True
+
+    def write(self, data):
+        send_message(self, {'output': data})
+
+    def flush(self):
+        pass
+
+def send_message(stream_output, message):
+    if not stream_output.connected:
+        return
+    try:
+        stream_output.wfile.write(json.dumps(message) + '\n')
+        stream_output.wfile.flush()
+    except IOError:
+        stream_output.connected = False
+
+class ReleaseDaemon:
+    # Serves release requests over a Unix socket.  Each request is one line of
+    # JSON, an entry like those of a fleet plan.  The daemon answers with
+    # lines of JSON: output messages while the release runs and a result
+    # message, the fleet summary of the release, at the end.
+    # The repositories stay open between requests, so GitPython's cat-file
+    # processes, the tag index and the manifest cache stay warm.  Releases
+    # of the same repository run one at a time, in the order they arrive;
+    # releases of different repositories run concurrently within the build
+    # and git limits.
+    # With coalesce_snapshots, a snapshot request joins the compatible
+    # snapshot release already queued for the repository, if it has not
+    # started yet, and gets its outcome and tags.  That release checks out
+    # develop when it starts, so it releases the newest head any of the
+    # requests asked for.  snapshot_interval spaces out the snapshot releases
+    # of a repository, and requests arriving in the meantime coalesce too.
+    def __init__(self, socket_path, max_builds, max_git_ops, log_dir, build_cache_dir=None,
+                 coalesce_snapshots=False, snapshot_interval=0):
+        self.socket_path = socket_path
+        self.build_slot = threading.BoundedSemaphore(max_builds)
+        self.git_slot = threading.BoundedSemaphore(max_git_ops)
+        self.log_dir = log_dir
+        self.build_cache_dir = build_cache_dir
+        self.coalesce_snapshots = coalesce_snapshots
+        self.snapshot_interval = snapshot_interval
+        self.server = None
+        self._lock = threading.Lock()
+        # Keyed by the real path of the repository.
+        self._repos = {}
+        self._queues = {}
+        self._snapshot_starts = {}
+
+    def serve(self):
+        import SocketServer
+        release_daemon = self
+
+        class RequestHandler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                release_daemon.handle(self.rfile, self.wfile)
+
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = SocketServer.ThreadingUnixStreamServer(self.socket_path, RequestHandler)
+        self.server.daemon_threads = True
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = ThreadOutput(stdout), ThreadOutput(stderr)
+        try:
+            self.server.serve_forever()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            self.server.server_close()
+            os.remove(self.socket_path)
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def handle(self, rfile, wfile):
+        stream_output = StreamOutput(wfile)
+        try:
+            fleet_release = read_fleet_release(json.loads(rfile.readline()), os.getcwd())
+        except (ValueError, KeyError, AttributeError) as e:
+            fleet_release = FleetRelease('', '', '')
+            fleet_release.status = FLEET_STATUS_INVALID
+            fleet_release.error = 'The request is not a valid release request: {}'.format(e)
+        if fleet_release.status != FLEET_STATUS_INVALID:
+            self.release(fleet_release, stream_output)
+        send_message(stream_output, {'result': fleet_release.to_json()})
+
+    def release(self, fleet_release, stream_output):
+        repo_key = os.path.realpath(fleet_release.repo_dir)
+        coalesce_key = snapshot_coalesce_key(fleet_release) if self.coalesce_snapshots else None
+        with self._lock:
+            repo_queue = self._queues.setdefault(repo_key, [])
+            queued = next((
+                q for q in repo_queue
+                if coalesce_key is not None and not q.started and q.coalesce_key == coalesce_key
+            ), None)
+            if queued is None:
+                queued = QueuedRelease(fleet_release, coalesce_key)
+                repo_queue.append(queued)
+                if len(repo_queue) == 1:
+                    queued.turn.set()
+        if queued.fleet_release is not fleet_release:
+            self.join_release(queued, fleet_release, stream_output)
+            return
+
+        if not queued.turn.is_set():
+            send_message(stream_output, {'output': 'Waiting for the releases of {} queued before this one.\n'.format(fleet_release.repo_dir)})
+        queued.turn.wait()
+
+        try:
+            if fleet_release.release_type == RELEASE_TYPE_SNAPSHOT:
+                self.wait_for_snapshot_interval(repo_key, stream_output)
+            with self._lock:
+                queued.started = True
+                if fleet_release.release_type == RELEASE_TYPE_SNAPSHOT:
+                    self._snapshot_starts[repo_key] = monotonic_time()
+            with open(os.path.join(self.log_dir, fleet_log_name(fleet_release)), 'a') as log:
+                sys.stdout.register(stream_output)
+                sys.stderr.register(stream_output)
+                try:
+                    release_context = fleet_release.new_release_context(
+                        self.build_slot,
+                        self.git_slot,
+                        log,
+                        self.build_cache_dir,
+                        repo=self.repo(repo_key)
+                    )
+                    fleet_release.run(release_context, log.name)
+                finally:
+                    sys.stdout.register(sys.stdout.default)
+                    sys.stderr.register(sys.stderr.default)
+        finally:
+            queued.done.set()
+            with self._lock:
+                repo_queue.pop(0)
+                if repo_queue:
+                    repo_queue[0].turn.set()
+                else:
+                    del self._queues[repo_key]
+
+    def join_release(self, queued, fleet_release, stream_output):
+        # Waits for the release fleet_release was coalesced into and takes
+        # its outcome.
+        start = monotonic_time()
+        send_message(stream_output, {'output': 'Coalesced into the snapshot release of {} that is waiting to start.\n'.format(fleet_release.repo_dir)})
+        queued.done.wait()
+        fleet_release.status = queued.fleet_release.status
+        fleet_release.error = queued.fleet_release.error
+        fleet_release.tags = queued.fleet_release.tags
+        fleet_release.coalesced_into = queued.fleet_release.name
+        fleet_release.duration = monotonic_time() - start
+        if fleet_release.status == FLEET_STATUS_RELEASED:
+            send_message(stream_output, {'output': 'Released as {}.\n'.format(', '.join(fleet_release.tags))})
+
+    def wait_for_snapshot_interval(self, repo_key, stream_output):
+        with self._lock:
+            last_start = self._snapshot_starts.get(repo_key)
+        if last_start is None:
+            return
+        delay = last_start + self.snapshot_interval - monotonic_time()
+        if delay > 0:
+            send_message(stream_output, {'output': 'Waiting {:.1f}s since the last snapshot release of this repository.\n'.format(delay)})
+            time.sleep(delay)
+
+    def repo(self, repo_key):
+        # Only the thread whose turn it is uses the repository, so its
+        # handle can be shared between requests.
+        with self._lock:
+            if repo_key not in self._repos:
+                from git import Repo
+                self._repos[repo_key] = Repo(repo_key)
+            return self._repos[repo_key]
+
+class QueuedRelease:
+    # A release in a daemon's queue for its repository, along with the
+    # requests coalesced into it.
+    def __init__(self, fleet_release, coalesce_key):
+        self.fleet_release = fleet_release
+        self.coalesce_key = coalesce_key
+        # Set when it is this release's turn and once it has finished.
+        self.turn = threading.Event()
+        self.done = threading.Event()
+        # Requests can only be coalesced into a release that has not
+        # started.
+        self.started = False
+
+def snapshot_coalesce_key(fleet_release):
+    # Snapshot requests with the same key would make the same release, so
+    # one release can answer all of them.  Resumed releases are never
+    # coalesced.
+    if fleet_release.release_type != RELEASE_TYPE_SNAPSHOT or fleet_release.resume:
+        return None
+    return (
+        fleet_release.version,
+        fleet_release.cargo_file,
+        fleet_release.version_file,
+        fleet_release.readme_file,
+        fleet_release.workspace,
+        fleet_release.dry_run
+    )
+
+def submit_release(socket_path, request, output=None):
+    # Sends a release request to the daemon and writes its output to output,
+    # or stdout, as it arrives.  Returns the result of the release.
+    output = output or sys.stdout
+    import socket
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path)
+    try:
+        connection.sendall(json.dumps(request) + '\n')
+        for line in connection.makefile('r'):
+            message = json.loads(line)
+            if 'result' in message:
+                return message['result']
+            output.write(message['output'].encode('utf-8'))
+    finally:
+        connection.close()
+    return {'status': FLEET_STATUS_FAILED, 'error': 'The daemon closed the connection before the release finished.'}
 
 if __name__=='__main__':
     main()
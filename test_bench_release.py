@@ -0,0 +1,24 @@
+import bench_release
+import git
+
+def test_generate_repository_creates_a_clone_of_a_bare_origin_on_develop(tmpdir):
+    size = dict(bench_release.SIZES['tiny'], commits=3, tags=2, branches=1)
+
+    bench_release.generate_repository(str(tmpdir.join('repo')), size)
+
+    repo = git.Repo(str(tmpdir.join('repo', 'work')))
+    assert repo.active_branch.name == 'develop'
+    assert not repo.is_dirty()
+    assert sorted(t.name for t in repo.tags) == ['v0.0.0', 'v0.1.0']
+    assert sorted(h.name for h in repo.heads) == ['develop', 'feature/0', 'master', 'testmaster']
+    assert len(list(repo.iter_commits('develop'))) == 4
+    origin = git.Repo(str(tmpdir.join('repo', 'origin.git')))
+    assert origin.heads.develop.commit == repo.heads.develop.commit
+
+def test_compare_results_reports_benchmarks_slower_than_the_threshold():
+    baseline = {'tiny': {'commit_release': 0.1, 'tag_release': 0.1}}
+    results = {'tiny': {'commit_release': 0.2, 'tag_release': 0.11, 'sync_index': 0.1}}
+
+    regressions = bench_release.compare_results(results, baseline, 1.25)
+
+    assert regressions == [('tiny', 'commit_release', 2.0)]
@@ -1,7 +1,15 @@
 import release
 import semantic_version
 import datetime
+import io
+import json
+import subprocess
+import sys
+import threading
+import time
 import mock
+import pytest
+import git
 
 def test_confirm_version_should_require_user_retry_given_invalid_semver_user_input():
     release_context = release.ReleaseContext(
@@ -266,3 +274,924 @@ def test_to_final_release_version_converts_snapshot_to_final_version():
     final_version = release.to_final_release_version(original_version)
 
     assert final_version == semantic_version.Version('1.0.0')
+
+def write_workspace(root):
+    root.join('Cargo.toml').write('[workspace]\nmembers = ["crates/*", "tools"]\nexclude = ["crates/ignored"]\n')
+    for name, version in [('alpha', '1.0.0-SNAPSHOT'), ('beta', '2.3.0-SNAPSHOT'), ('ignored', '0.1.0')]:
+        crate_dir = root.join('crates', name)
+        crate_dir.ensure(dir=True)
+        crate_dir.join('Cargo.toml').write('[package]\nname = "{}"\nversion = "{}"\n'.format(name, version))
+        crate_dir.join('README.md').write('```toml\n[dependencies]\n{} = {}\n```\n'.format(name, version))
+        crate_dir.join('src', 'version.txt').write(version, ensure=True)
+    root.join('tools').ensure(dir=True)
+    root.join('tools', 'Cargo.toml').write('[package]\nname = "tools"\nversion = "0.5.0-SNAPSHOT"\n')
+
+def test_read_workspace_members_finds_members_and_skips_excluded_crates(tmpdir):
+    write_workspace(tmpdir)
+    release_context = release.ReleaseContext(
+        release_type = 'final',
+        cargo_file = str(tmpdir.join('Cargo.toml')),
+        version_file = 'version.txt',
+        readme_file = 'README.md',
+        disable_checks = False,
+        dry_run = False,
+        workspace = True
+    )
+
+    members = release.read_workspace_members(release_context)
+
+    assert [m.cargo_file for m in members] == [
+        str(tmpdir.join('crates', 'alpha', 'Cargo.toml')),
+        str(tmpdir.join('crates', 'beta', 'Cargo.toml')),
+        str(tmpdir.join('tools', 'Cargo.toml')),
+    ]
+    assert members[2].version_file is None
+    assert members[2].readme_file is None
+
+def test_read_workspace_release_versions_uses_the_default_version_for_each_member(tmpdir):
+    write_workspace(tmpdir)
+    release_context = release.ReleaseContext(
+        release_type = 'final',
+        cargo_file = str(tmpdir.join('Cargo.toml')),
+        version_file = 'version.txt',
+        readme_file = 'README.md',
+        disable_checks = False,
+        dry_run = False,
+        workspace = True
+    )
+
+    crate_versions = release.read_workspace_release_versions(release_context)
+
+    assert [(c.name, str(v)) for c, v in crate_versions] == [
+        ('alpha', '1.0.0'),
+        ('beta', '2.3.0'),
+        ('tools', '0.5.0'),
+    ]
+
+def test_update_crates_version_in_files_updates_every_member_in_parallel(tmpdir):
+    write_workspace(tmpdir)
+    release_context = release.ReleaseContext(
+        release_type = 'final',
+        cargo_file = str(tmpdir.join('Cargo.toml')),
+        version_file = 'version.txt',
+        readme_file = 'README.md',
+        disable_checks = False,
+        dry_run = False,
+        workspace = True,
+        jobs = 2
+    )
+    crate_versions = release.read_workspace_release_versions(release_context)
+
+    release.update_crates_version_in_files(release_context, crate_versions)
+
+    assert 'version = "2.3.0"' in tmpdir.join('crates', 'beta', 'Cargo.toml').read()
+    assert tmpdir.join('crates', 'beta', 'src', 'version.txt').read() == '2.3.0'
+    assert 'beta = 2.3.0\n' in tmpdir.join('crates', 'beta', 'README.md').read()
+    assert 'version = "0.5.0"' in tmpdir.join('tools', 'Cargo.toml').read()
+
+def test_release_tag_prefixes_the_crate_name_in_workspace_mode():
+    release_context = release.ReleaseContext(
+        release_type = 'final',
+        cargo_file = 'Cargo.toml',
+        version_file = 'version.txt',
+        readme_file = 'README.md',
+        disable_checks = False,
+        dry_run = False,
+        workspace = True
+    )
+    crate = release.Crate('alpha', 'Cargo.toml', None, None)
+
+    assert release.release_tag(release_context, crate, semantic_version.Version('1.2.3')) == 'alpha-v1.2.3'
+
+def init_repo(path):
+    repo = git.Repo.init(str(path))
+    repo.git.config('user.email', 'release@example.com')
+    repo.git.config('user.name', 'Release Test')
+    path.join('Cargo.toml').write('[package]\nname = "vors"\nversion = "1.0.0-SNAPSHOT"\n')
+    path.join('README.md').write('vors = 1.0.0-SNAPSHOT\n')
+    path.join('src', 'version.txt').write('1.0.0-SNAPSHOT', ensure=True)
+    repo.git.add(A=True)
+    repo.index.commit('Initial commit.')
+    return repo
+
+def test_build_cache_returns_a_stored_result_for_the_same_key(tmpdir):
+    build_cache = release.BuildCache(str(tmpdir.join('cache')))
+    key = build_cache.key('tree', 'rustc 1.0.0', release.BUILD_CMD)
+
+    build_cache.store(key, 1, {})
+
+    assert build_cache.lookup(key)['result'] == 1
+    assert build_cache.lookup(build_cache.key('other tree', 'rustc 1.0.0', release.BUILD_CMD)) is None
+
+def test_build_cache_misses_when_a_successful_build_lost_its_artifacts(tmpdir):
+    artifact_dir = tmpdir.join('target', 'release')
+    artifact_dir.join('vors').write('binary', ensure=True)
+    build_cache = release.BuildCache(str(tmpdir.join('cache')))
+    key = build_cache.key('tree', 'rustc 1.0.0', release.BUILD_CMD)
+    build_cache.store(key, 0, release.checksum_artifacts(str(artifact_dir)))
+
+    assert build_cache.lookup(key, artifact_dir=str(artifact_dir)) is not None
+
+    artifact_dir.join('vors').write('rebuilt binary')
+
+    assert build_cache.lookup(key, artifact_dir=str(artifact_dir)) is None
+
+def test_build_cache_evicts_old_entries_then_the_oldest_entries_over_the_size_limit(tmpdir):
+    build_cache = release.BuildCache(str(tmpdir), max_age=100, max_bytes=1)
+    for age, key in [(200, 'expired'), (50, 'older'), (10, 'newer')]:
+        build_cache.store(key, 0, {})
+        tmpdir.join('{}.json'.format(key)).setmtime(1000 - age)
+    size = tmpdir.join('newer.json').size()
+    build_cache.max_bytes = size
+
+    build_cache.evict(now=1000)
+
+    assert sorted(p.basename for p in tmpdir.listdir()) == ['newer.json']
+
+def test_attempt_cached_build_skips_the_build_for_an_unchanged_tree(tmpdir):
+    init_repo(tmpdir)
+    with tmpdir.as_cwd():
+        release_context = release.ReleaseContext(
+            release_type = 'final',
+            cargo_file = 'Cargo.toml',
+            version_file = 'src/version.txt',
+            readme_file = 'README.md',
+            disable_checks = False,
+            dry_run = False,
+            build_cache_dir = str(tmpdir.join('.cache'))
+        )
+        with mock.patch('release.attempt_build', return_value=(0, None)) as attempt_build:
+            assert release.attempt_cached_build(release_context) == (0, None)
+            assert release.attempt_cached_build(release_context) == (0, None)
+            tmpdir.join('README.md').write('vors = 1.0.0\n')
+            assert release.attempt_cached_build(release_context) == (0, None)
+
+    assert attempt_build.call_count == 2
+
+def write_fake_build(tmpdir, script):
+    tmpdir.join('build.py').write(script)
+    return '{} {}'.format(sys.executable, tmpdir.join('build.py'))
+
+def test_attempt_build_reports_crate_progress_and_stops_at_the_first_error(tmpdir, monkeypatch):
+    monkeypatch.setattr(release, 'BUILD_CMD', write_fake_build(tmpdir, '\n'.join([
+        'import json, sys, time',
+        'print json.dumps({"reason": "compiler-artifact", "target": {"name": "libc"}})',
+        'print json.dumps({"reason": "compiler-message", "message": {"level": "error", "rendered": "error[E0425]: cannot find value"}})',
+        'sys.stdout.flush()',
+        'time.sleep(30)',
+    ])))
+    output = io.BytesIO()
+    start = release.monotonic_time()
+    with mock.patch('sys.stdout', io.BytesIO()) as stdout:
+        build_result, error = release.attempt_build(str(tmpdir), output, fail_fast=True)
+
+    assert release.monotonic_time() - start < 10
+    assert (build_result, error) == (1, 'error[E0425]: cannot find value\n')
+    assert stdout.getvalue() == 'Built libc (1 crates).\n'
+    assert output.getvalue() == 'error[E0425]: cannot find value\n'
+
+def test_attempt_build_stops_a_quiet_build_and_keeps_only_the_last_output(tmpdir, monkeypatch):
+    monkeypatch.setattr(release, 'BUILD_CMD', write_fake_build(tmpdir, '\n'.join([
+        'import sys, time',
+        'for i in range(1000): print "line", i',
+        'sys.exit(1)',
+    ])))
+    build_result, error = release.attempt_build(str(tmpdir), io.BytesIO())
+
+    assert build_result == 1
+    assert error.splitlines() == ['line {}'.format(i) for i in range(1000 - release.BUILD_TAIL_LINES, 1000)]
+
+    monkeypatch.setattr(release, 'BUILD_CMD', write_fake_build(tmpdir, 'import time\ntime.sleep(30)\n'))
+    assert release.attempt_build(str(tmpdir), io.BytesIO(), idle_timeout=0.2) == (1, 'The build printed nothing for 0.2 seconds.')
+
+def test_update_cargo_file_version_only_rewrites_the_package_version(tmpdir):
+    cargo_file = tmpdir.join('Cargo.toml')
+    cargo_file.write(
+        '[package]\n'
+        'name = "vors"\n'
+        'version = "1.0.0-SNAPSHOT" # the release version\n'
+        '\n'
+        '[dependencies.semver]\n'
+        'version = "0.1.0"\n'
+    )
+    crate = release.Crate('vors', str(cargo_file), None, None)
+
+    changed_ranges = release.update_cargo_file_version(crate, '1.0.0')
+
+    assert cargo_file.read() == (
+        '[package]\n'
+        'name = "vors"\n'
+        'version = "1.0.0" # the release version\n'
+        '\n'
+        '[dependencies.semver]\n'
+        'version = "0.1.0"\n'
+    )
+    assert changed_ranges == [(35, 49)]
+
+def test_update_readme_file_version_reports_the_changed_byte_ranges(tmpdir):
+    readme_file = tmpdir.join('README.md')
+    readme_file.write('# vors\n\nvors = 1.0.0\nother = 1.0.0\nvors = 1.10.0-SNAPSHOT\n')
+    crate = release.Crate('vors', 'Cargo.toml', None, str(readme_file))
+
+    changed_ranges = release.update_readme_file_version(crate, 'vors', '1.10.1')
+
+    assert readme_file.read() == '# vors\n\nvors = 1.10.1\nother = 1.0.0\nvors = 1.10.1\n'
+    assert changed_ranges == [(8, 21), (35, 58)]
+
+def test_update_version_file_leaves_the_file_untouched_when_the_version_is_unchanged(tmpdir):
+    version_file = tmpdir.join('version.txt')
+    version_file.write('1.0.0')
+    version_file.setmtime(1000)
+    crate = release.Crate('vors', 'Cargo.toml', str(version_file), None)
+
+    assert release.update_version_file(crate, '1.0.0') == []
+    assert version_file.mtime() == 1000
+
+    assert release.update_version_file(crate, '1.0.1') == [(0, 5)]
+    assert version_file.read() == '1.0.1'
+    assert [p.basename for p in tmpdir.listdir()] == ['version.txt']
+
+def test_commit_release_commits_only_the_changed_files_without_touching_the_index(tmpdir):
+    repo = init_repo(tmpdir)
+    tmpdir.join('notes.txt').write('not part of the release')
+    with tmpdir.as_cwd():
+        release_context = release.ReleaseContext(
+            release_type = 'final',
+            cargo_file = 'Cargo.toml',
+            version_file = 'src/version.txt',
+            readme_file = 'README.md',
+            disable_checks = False,
+            dry_run = False
+        )
+        crate = release.Crate('vors', 'Cargo.toml', 'src/version.txt', 'README.md')
+        release.update_crates_version_in_files(release_context, [(crate, semantic_version.Version('1.0.0'))])
+        index_before = tmpdir.join('.git', 'index').read_binary()
+
+        release_context.commit_release('Release commit for 1.0.0.')
+
+        assert tmpdir.join('.git', 'index').read_binary() == index_before
+        assert repo.head.commit.message == 'Release commit for 1.0.0.'
+        assert repo.git.show('HEAD:src/version.txt') == '1.0.0'
+        assert repo.git.show('HEAD:README.md') == 'vors = 1.0.0'
+        assert sorted(repo.head.commit.stats.files) == ['Cargo.toml', 'README.md', 'src/version.txt']
+
+        release_context.sync_index()
+
+        assert not repo.is_dirty()
+        assert repo.git.status(porcelain=True) == '?? notes.txt'
+
+def test_merge_develop_into_fast_forwards_the_branch_without_a_checkout(tmpdir):
+    repo = init_repo(tmpdir)
+    repo.git.branch('-m', 'master')
+    repo.git.checkout('-b', 'develop')
+    tmpdir.join('README.md').write('vors = 1.0.0\n')
+    repo.git.commit('-am', 'Release commit for 1.0.0.')
+    with tmpdir.as_cwd():
+        release_context = release.ReleaseContext(
+            release_type = 'final',
+            cargo_file = 'Cargo.toml',
+            version_file = 'src/version.txt',
+            readme_file = 'README.md',
+            disable_checks = False,
+            dry_run = False
+        )
+
+        release_context.merge_develop_into('master')
+
+    assert repo.heads.master.commit == repo.heads.develop.commit
+    assert repo.active_branch.name == 'develop'
+
+def test_merge_develop_into_merges_in_memory_when_the_branch_has_diverged(tmpdir):
+    repo = init_repo(tmpdir)
+    repo.git.branch('-m', 'master')
+    repo.git.checkout('-b', 'develop')
+    tmpdir.join('README.md').write('vors = 1.0.0\n')
+    repo.git.commit('-am', 'Release commit for 1.0.0.')
+    repo.git.checkout('master')
+    tmpdir.join('HOTFIX.md').write('hotfix\n')
+    repo.git.add('HOTFIX.md')
+    repo.git.commit('-m', 'Hotfix.')
+    master_commit = repo.heads.master.commit
+    repo.git.checkout('develop')
+    with tmpdir.as_cwd():
+        release_context = release.ReleaseContext(
+            release_type = 'final',
+            cargo_file = 'Cargo.toml',
+            version_file = 'src/version.txt',
+            readme_file = 'README.md',
+            disable_checks = False,
+            dry_run = False
+        )
+
+        release_context.merge_develop_into('master')
+
+    merge_commit = repo.heads.master.commit
+    assert merge_commit.parents == (master_commit, repo.heads.develop.commit)
+    assert merge_commit.message == "Merge branch 'develop'"
+    assert repo.git.show('master:HOTFIX.md') == 'hotfix'
+    assert repo.git.show('master:README.md') == 'vors = 1.0.0'
+    assert repo.active_branch.name == 'develop'
+    assert not tmpdir.join('HOTFIX.md').exists()
+
+def test_release_trace_records_the_work_done_in_each_stage():
+    trace = release.ReleaseTrace()
+
+    with trace.stage('update_version_in_files'):
+        trace.count('bytes_written', 120)
+    with trace.stage('commit_release'):
+        trace.count('git_objects', 3)
+
+    assert [s['name'] for s in trace.stages] == ['update_version_in_files', 'commit_release']
+    assert [s['bytes_written'] for s in trace.stages] == [120, 0]
+    assert [s['git_objects'] for s in trace.stages] == [0, 3]
+    assert all(s['duration'] >= 0 for s in trace.stages)
+    assert trace.to_json()['totals']['git_objects'] == 3
+
+def test_release_trace_writes_chrome_trace_events_and_stage_profiles(tmpdir):
+    trace = release.ReleaseTrace(profile_dir=str(tmpdir.join('profiles')))
+    with trace.stage('attempt_build'):
+        pass
+
+    trace.write(str(tmpdir.join('trace.json')), release.TRACE_FORMAT_CHROME)
+
+    events = json.loads(tmpdir.join('trace.json').read())['traceEvents']
+    assert [(e['name'], e['ph']) for e in events] == [('attempt_build', 'X')]
+    assert tmpdir.join('profiles', '01-attempt_build.prof').check()
+
+def test_importing_release_does_not_import_the_heavy_dependencies():
+    script = (
+        'import sys, release\n'
+        'release.ReleaseContext("bogus", "Cargo.toml", "version.txt", "README.md", False, False)\n'
+        'print(sorted(m for m in ("git", "contoml", "semantic_version", "multiprocessing") if m in sys.modules))\n'
+    )
+
+    output = subprocess.check_output([sys.executable, '-c', script])
+
+    assert output.strip() == '[]'
+
+def test_release_context_opens_the_repository_on_first_use(tmpdir):
+    repo = init_repo(tmpdir)
+    with tmpdir.as_cwd():
+        release_context = release.ReleaseContext(
+            release_type = 'final',
+            cargo_file = 'Cargo.toml',
+            version_file = 'src/version.txt',
+            readme_file = 'README.md',
+            disable_checks = False,
+            dry_run = False
+        )
+
+        assert '_repo' not in vars(release_context)
+        assert release_context.repo_active_branch() == repo.active_branch.name
+        assert '_repo' in vars(release_context)
+
+def init_release_repo(path):
+    # A repository on develop with master, testmaster and a bare origin.
+    repo = init_repo(path.join('work'))
+    repo.git.branch('-m', 'master')
+    repo.git.branch('testmaster')
+    repo.git.checkout('-b', 'develop')
+    git.Repo.init(str(path.join('origin.git')), bare=True)
+    repo.git.remote('add', 'origin', str(path.join('origin.git')))
+    repo.git.push('origin', 'refs/heads/*:refs/heads/*')
+    return repo
+
+def test_read_fleet_plan_rejects_versions_that_do_not_fit_the_release_type(tmpdir):
+    tmpdir.join('alpha').ensure(dir=True)
+    tmpdir.join('plan.json').write(json.dumps([
+        {'repo': 'alpha', 'release_type': 'final', 'version': '1.1.0'},
+        {'repo': 'alpha', 'release_type': 'snapshot', 'version': '1.1.0'},
+        {'repo': 'missing', 'release_type': 'final'},
+        {'repo': 'alpha', 'release_type': 'nightly'},
+    ]))
+
+    fleet_releases = release.read_fleet_plan(str(tmpdir.join('plan.json')))
+
+    assert [r.status for r in fleet_releases] == ['pending', 'invalid', 'invalid', 'invalid']
+    assert fleet_releases[0].repo_dir == str(tmpdir.join('alpha'))
+
+def test_fleet_runs_every_release_in_the_plan_and_collects_the_results(tmpdir, monkeypatch):
+    monkeypatch.setattr(release, 'BUILD_CMD', 'true')
+    alpha = init_release_repo(tmpdir.join('alpha'))
+    beta = init_release_repo(tmpdir.join('beta'))
+    tmpdir.join('beta', 'work', 'README.md').write('uncommitted\n')
+    tmpdir.join('plan.json').write(json.dumps([
+        {'repo': 'alpha/work', 'release_type': 'final', 'version': '1.2.0'},
+        {'repo': 'beta/work', 'release_type': 'final', 'version': '1.2.0'},
+    ]))
+    fleet_releases = release.read_fleet_plan(str(tmpdir.join('plan.json')))
+    fleet = release.Fleet(4, 1, 2, str(tmpdir.join('logs')))
+
+    fleet.run(fleet_releases)
+
+    assert [r.status for r in fleet_releases] == ['released', 'failed']
+    assert fleet_releases[0].tags == ['v1.2.0']
+    assert alpha.heads.master.commit == alpha.tags['v1.2.0'].commit
+    assert alpha.git.show('develop:src/version.txt') == '1.2.1-SNAPSHOT'
+    assert 'uncommited changes' in tmpdir.join('logs', 'beta_work.log').read()
+    assert 'v1.2.0' not in [t.name for t in beta.tags]
+
+def test_read_cargo_file_reuses_the_scanned_manifest_until_the_file_changes(tmpdir):
+    cargo_file = tmpdir.join('Cargo.toml')
+    cargo_file.write('[package]\nname = "vors"\nversion = "1.0.0-SNAPSHOT"\n')
+    crate = release.Crate('vors', str(cargo_file), None, None)
+
+    assert release.read_cargo_file(crate) == ('1.0.0-SNAPSHOT', 'vors')
+    manifest = release.read_cargo_manifest(str(cargo_file))
+    release.update_cargo_file_version(crate, '1.0.0')
+
+    assert release.read_cargo_manifest(str(cargo_file)) is manifest
+    assert release.read_cargo_file(crate) == ('1.0.0', 'vors')
+
+    cargo_file.write('[package]\nname = "renamed"\nversion = "2.0.0"\n')
+
+    assert release.read_cargo_file(crate) == ('2.0.0', 'renamed')
+
+def test_update_crates_version_in_files_patches_the_matching_cargo_lock_entry(tmpdir):
+    repo = init_repo(tmpdir)
+    cargo_lock = (
+        '[[package]]\n'
+        'name = "semver"\n'
+        'version = "1.0.0-SNAPSHOT"\n'
+        'source = "registry+https://github.com/rust-lang/crates.io-index"\n'
+        '\n'
+        '[[package]]\n'
+        'name = "vors"\n'
+        'version = "1.0.0-SNAPSHOT"\n'
+        'dependencies = [\n'
+        ' "semver",\n'
+        ']\n'
+    )
+    tmpdir.join('Cargo.lock').write(cargo_lock)
+    repo.git.add('Cargo.lock')
+    repo.index.commit('Track Cargo.lock.')
+    with tmpdir.as_cwd():
+        release_context = release.ReleaseContext(
+            release_type = 'final',
+            cargo_file = 'Cargo.toml',
+            version_file = 'src/version.txt',
+            readme_file = 'README.md',
+            disable_checks = False,
+            dry_run = False
+        )
+        crate = release.Crate('vors', 'Cargo.toml', 'src/version.txt', 'README.md')
+
+        release.update_crates_version_in_files(release_context, [(crate, semantic_version.Version('1.0.0'))])
+        release_context.commit_release('Release commit for 1.0.0.')
+
+    assert tmpdir.join('Cargo.lock').read() == cargo_lock.replace(
+        'name = "vors"\nversion = "1.0.0-SNAPSHOT"', 'name = "vors"\nversion = "1.0.0"'
+    )
+    assert 'Cargo.lock' in repo.head.commit.stats.files
+
+def test_push_release_pushes_only_the_release_refs_to_every_remote(tmpdir):
+    repo = init_release_repo(tmpdir)
+    git.Repo.init(str(tmpdir.join('mirror.git')), bare=True)
+    repo.git.remote('add', 'mirror', str(tmpdir.join('mirror.git')))
+    repo.git.branch('stale')
+    repo.git.tag('stale-tag')
+    with tmpdir.join('work').as_cwd():
+        release_context = release.ReleaseContext(
+            release_type = 'final',
+            cargo_file = 'Cargo.toml',
+            version_file = 'src/version.txt',
+            readme_file = 'README.md',
+            disable_checks = False,
+            dry_run = False,
+            remotes = ['origin', 'mirror']
+        )
+        crate = release.Crate('vors', 'Cargo.toml', 'src/version.txt', 'README.md')
+        release.update_crates_version_in_files(release_context, [(crate, semantic_version.Version('1.0.0'))])
+        release_context.commit_release('Release commit for 1.0.0.')
+        release_context.tag_release('v1.0.0', 'v1.0.0')
+
+        assert release_context.push_release() == []
+
+    assert release_context.release_refs == ['refs/heads/develop', 'refs/tags/v1.0.0']
+    for remote in ['origin.git', 'mirror.git']:
+        remote_repo = git.Repo(str(tmpdir.join(remote)))
+        assert remote_repo.heads.develop.commit == repo.heads.develop.commit
+        assert [t.name for t in remote_repo.tags] == ['v1.0.0']
+        assert 'stale' not in [h.name for h in remote_repo.heads]
+
+def test_push_release_retries_and_reports_remotes_that_keep_failing(tmpdir):
+    repo = init_release_repo(tmpdir)
+    repo.git.remote('add', 'broken', str(tmpdir.join('missing.git')))
+    with tmpdir.join('work').as_cwd():
+        release_context = release.ReleaseContext(
+            release_type = 'final',
+            cargo_file = 'Cargo.toml',
+            version_file = 'src/version.txt',
+            readme_file = 'README.md',
+            disable_checks = False,
+            dry_run = False,
+            remotes = ['origin', 'broken'],
+            push_retries = 1
+        )
+        release_context.tag_release('v1.0.0', 'v1.0.0')
+        with mock.patch('time.sleep') as sleep:
+            errors = release_context.push_release()
+
+    assert sleep.call_count == 1
+    assert [remote for remote, _ in errors] == ['broken']
+    assert 'v1.0.0' in [t.name for t in git.Repo(str(tmpdir.join('origin.git'))).tags]
+
+def test_version_tag_index_reads_packed_and_loose_release_tags(tmpdir):
+    repo = init_repo(tmpdir)
+    for tag in ['v1.0.0', 'v1.0.1', 'v1.1.0', 'alpha-v2.0.0', 'not-a-release']:
+        repo.create_tag(tag)
+    repo.git.pack_refs('--all')
+    repo.create_tag('v1.0.3')
+
+    tag_index = release.VersionTagIndex(repo.git_dir)
+
+    assert 'v1.0.3' in tag_index
+    assert 'not-a-release' not in tag_index
+    assert [str(v) for v in tag_index.versions('v')] == ['1.0.0', '1.0.1', '1.0.3', '1.1.0']
+    assert [str(v) for v in tag_index.versions('alpha-v')] == ['2.0.0']
+    assert str(tag_index.next_free_patch('v', semantic_version.Version('1.0.0'))) == '1.0.2'
+    assert str(tag_index.next_free_minor('v', semantic_version.Version('1.0.0'))) == '1.2.0'
+
+def test_version_tag_index_only_parses_tags_added_since_it_was_cached(tmpdir):
+    repo = init_repo(tmpdir)
+    repo.create_tag('v1.0.0')
+    repo.git.pack_refs('--all')
+    release.VersionTagIndex(repo.git_dir)
+    repo.create_tag('v1.0.1')
+
+    with mock.patch('release.parse_release_tag', return_value=['v', '1.0.1']) as parse_release_tag:
+        tag_index = release.VersionTagIndex(repo.git_dir)
+
+    parse_release_tag.assert_called_once_with('v1.0.1')
+    assert sorted(tag_index.tags) == ['v1.0.0', 'v1.0.1']
+
+def test_to_free_starting_version_skips_versions_that_are_already_tagged(tmpdir):
+    repo = init_repo(tmpdir)
+    repo.create_tag('v1.0.0')
+    repo.create_tag('v1.0.1')
+    release_context = release.ReleaseContext(
+        release_type = 'final',
+        cargo_file = 'Cargo.toml',
+        version_file = 'version.txt',
+        readme_file = 'README.md',
+        disable_checks = False,
+        dry_run = False
+    )
+    tag_index = release.VersionTagIndex(repo.git_dir)
+
+    starting_version = release.to_free_starting_version(release_context, tag_index, 'v', semantic_version.Version('1.0.0-SNAPSHOT'))
+
+    assert release.to_presentation_version(release_context, starting_version) == semantic_version.Version('1.0.2')
+
+def test_resumed_release_finishes_after_the_last_completed_stage(tmpdir, monkeypatch):
+    monkeypatch.setattr(release, 'BUILD_CMD', 'true')
+    repo = init_release_repo(tmpdir)
+    repo.git.remote('set-url', 'origin', str(tmpdir.join('missing.git')))
+    def new_release_context(resume):
+        return release.ReleaseContext(
+            release_type = 'final',
+            cargo_file = 'Cargo.toml',
+            version_file = 'src/version.txt',
+            readme_file = 'README.md',
+            disable_checks = False,
+            dry_run = False,
+            version = '1.0.0',
+            push_retries = 0,
+            resume = resume
+        )
+
+    with tmpdir.join('work').as_cwd():
+        with pytest.raises(SystemExit):
+            release.run_release(new_release_context(False))
+        journal = release.ReleaseJournal.read(str(tmpdir.join('work', '.git', release.RELEASE_JOURNAL_FILE)))
+        assert journal.state['stages'][-1] == 'next_commit'
+        assert journal.state['head'] == repo.head.commit.hexsha
+
+        with pytest.raises(SystemExit):
+            release.run_release(new_release_context(False))
+
+        repo.git.remote('set-url', 'origin', str(tmpdir.join('origin.git')))
+        with mock.patch('release.attempt_cached_build') as attempt_cached_build:
+            assert release.run_release(new_release_context(True)) == ['v1.0.0']
+
+    assert not attempt_cached_build.called
+    assert not tmpdir.join('work', '.git', release.RELEASE_JOURNAL_FILE).check()
+    assert [c.message for c in repo.iter_commits('develop')][:2] == ['Bumped version to 1.0.1-SNAPSHOT.', 'Release commit for 1.0.0.']
+    origin = git.Repo(str(tmpdir.join('origin.git')))
+    assert origin.heads.develop.commit == repo.heads.develop.commit
+    assert origin.heads.master.commit == repo.tags['v1.0.0'].commit
+
+def test_release_daemon_streams_releases_and_keeps_the_repository_open(tmpdir, monkeypatch):
+    monkeypatch.setattr(release, 'BUILD_CMD', 'true')
+    repo = init_release_repo(tmpdir)
+    socket_path = str(tmpdir.join('daemon.sock'))
+    release_daemon = release.ReleaseDaemon(socket_path, 1, 1, str(tmpdir.join('logs')))
+    server = threading.Thread(target=release_daemon.serve)
+    server.start()
+    try:
+        while release_daemon.server is None:
+            time.sleep(0.01)
+        output = io.BytesIO()
+        result = release.submit_release(socket_path, {
+            'repo': str(tmpdir.join('work')), 'release_type': 'final', 'version': '1.1.0'
+        }, output)
+        invalid = release.submit_release(socket_path, {
+            'repo': str(tmpdir.join('work')), 'release_type': 'nightly'
+        }, output)
+        snapshot = release.submit_release(socket_path, {
+            'repo': str(tmpdir.join('work')), 'release_type': 'snapshot'
+        }, output)
+    finally:
+        release_daemon.shutdown()
+        server.join()
+
+    assert result['status'] == 'released'
+    assert result['tags'] == ['v1.1.0']
+    assert 'Releasing vors v1.1.0\n' in output.getvalue()
+    assert invalid['status'] == 'invalid'
+    assert snapshot['status'] == 'released'
+    assert repo.git.show('develop:src/version.txt') == '1.1.1-SNAPSHOT'
+    assert release_daemon._repos.keys() == [str(tmpdir.join('work').realpath())]
+    assert not tmpdir.join('daemon.sock').check()
+
+def test_release_daemon_coalesces_snapshot_requests_that_arrive_while_a_release_runs(tmpdir, monkeypatch):
+    git.Repo.init(str(tmpdir))
+    gate = threading.Event()
+    starts = []
+    def run_release(release_context):
+        starts.append((release_context.release_type, release.monotonic_time()))
+        if len(starts) == 1:
+            gate.wait()
+        return ['v{}'.format(len(starts))]
+    monkeypatch.setattr(release, 'run_release', run_release)
+    monkeypatch.setattr(sys, 'stdout', release.ThreadOutput(sys.stdout))
+    monkeypatch.setattr(sys, 'stderr', release.ThreadOutput(sys.stderr))
+    release_daemon = release.ReleaseDaemon(
+        None, 1, 1, str(tmpdir), coalesce_snapshots=True, snapshot_interval=0.2
+    )
+
+    def submit(release_type, wait_for):
+        fleet_release = release.FleetRelease('vors', str(tmpdir), release_type)
+        output = io.BytesIO()
+        thread = threading.Thread(target=release_daemon.release, args=(fleet_release, release.StreamOutput(output)))
+        thread.start()
+        while wait_for not in output.getvalue():
+            time.sleep(0.01)
+        return fleet_release, output, thread
+
+    final = submit('final', '')
+    while not starts:
+        time.sleep(0.01)
+    snapshots = [submit('snapshot', 'Waiting for the releases')]
+    snapshots += [submit('snapshot', 'Coalesced into') for _ in range(2)]
+    gate.set()
+    for _, _, thread in [final] + snapshots:
+        thread.join()
+    after = release.FleetRelease('vors', str(tmpdir), 'snapshot')
+    release_daemon.release(after, release.StreamOutput(io.BytesIO()))
+
+    assert [r for r, _ in starts] == ['final', 'snapshot', 'snapshot']
+    assert final[0].tags == ['v1']
+    assert [(r.status, r.tags, r.coalesced_into) for r, _, _ in snapshots] == [
+        ('released', ['v2'], None), ('released', ['v2'], 'vors'), ('released', ['v2'], 'vors')
+    ]
+    assert 'Released as v2.' in snapshots[1][1].getvalue()
+    assert after.tags == ['v3']
+    assert starts[2][1] - starts[1][1] >= 0.2
+    assert release_daemon._queues == {}
+
+def test_plan_release_works_out_the_release_without_changing_anything(tmpdir):
+    repo = init_release_repo(tmpdir)
+    with tmpdir.join('work').as_cwd():
+        release_context = release.ReleaseContext(
+            release_type = 'final',
+            cargo_file = 'Cargo.toml',
+            version_file = 'src/version.txt',
+            readme_file = 'README.md',
+            disable_checks = False,
+            dry_run = False,
+            version = '1.1.0',
+            remotes = ['origin', 'mirror']
+        )
+        plan = release.plan_release(release_context)
+
+    assert not repo.is_dirty()
+    assert [t.name for t in repo.tags] == []
+    assert plan['crates'] == [{'name': 'vors', 'release_version': '1.1.0', 'next_version': '1.1.1-SNAPSHOT'}]
+    assert [s['action'] for s in plan['steps']] == ['update_files', 'build', 'commit', 'tag', 'merge', 'update_files', 'commit', 'push']
+    release_files = plan['steps'][0]['files']
+    assert [f['path'] for f in release_files] == ['Cargo.toml', 'src/version.txt', 'README.md']
+    assert '-version = "1.0.0-SNAPSHOT"\n+version = "1.1.0"\n' in release_files[0]['diff']
+    assert release_files[1]['diff'].endswith('+1.1.0\n\\ No newline at end of file\n')
+    assert '-1.1.0\n\\ No newline at end of file\n+1.1.1-SNAPSHOT' in plan['steps'][5]['files'][1]['diff']
+    assert plan['steps'][4] == {'action': 'merge', 'from': 'develop', 'into': 'master', 'fast_forward': True}
+    assert plan['steps'][6]['message'] == 'Bumped version to 1.1.1-SNAPSHOT.'
+    assert plan['steps'][7] == {
+        'action': 'push',
+        'remotes': ['origin', 'mirror'],
+        'refs': ['refs/heads/develop', 'refs/tags/v1.1.0', 'refs/heads/master']
+    }
+
+def test_repo_is_dirty_fast_and_paths_checks(tmpdir):
+    repo = init_repo(tmpdir)
+    tmpdir.join('src', 'main.rs').write('fn main() {}\n')
+    repo.index.add(['src/main.rs'])
+    repo.index.commit('Add main.')
+    with tmpdir.as_cwd():
+        def repo_is_dirty(dirty_check, untracked=False):
+            return release.ReleaseContext(
+                release_type = 'final',
+                cargo_file = 'Cargo.toml',
+                version_file = 'src/version.txt',
+                readme_file = 'README.md',
+                disable_checks = False,
+                dry_run = False,
+                dirty_check = dirty_check,
+                dirty_check_untracked = untracked
+            ).repo_is_dirty()
+
+        assert not repo_is_dirty('fast')
+        tmpdir.join('notes.txt').write('untracked\n')
+        assert not repo_is_dirty('fast')
+        assert repo_is_dirty('fast', untracked=True)
+        assert not repo_is_dirty('paths', untracked=True)
+
+        tmpdir.join('src', 'main.rs').write('fn main() { panic!() }\n')
+        assert repo_is_dirty('fast')
+        assert not repo_is_dirty('paths')
+
+        tmpdir.join('README.md').write('vors = 2.0.0\n')
+        repo.index.add(['README.md'])
+        tmpdir.join('README.md').write(repo.git.show('HEAD:README.md') + '\n')
+        assert repo_is_dirty('paths')
+        assert repo_is_dirty('full')
+
+def test_update_version_occurrences_rewrites_every_indexed_site(tmpdir):
+    repo = init_repo(tmpdir)
+    tmpdir.join('Dockerfile').write('FROM rust\nENV VORS_VERSION=1.0.0-SNAPSHOT\nENV OTHER=1.0.0-SNAPSHOT\n')
+    tmpdir.join('docs', 'install.md').write('Add vors-derive 1.0.0-SNAPSHOT.\nAdd vors 1.0.0-SNAPSHOT.\n', ensure=True)
+    tmpdir.join('logo.png').write('\0vors 1.0.0-SNAPSHOT\n')
+    repo.index.add(['Dockerfile', 'docs/install.md', 'logo.png'])
+    repo.index.commit('Add docs.')
+    with tmpdir.as_cwd():
+        release_context = release.ReleaseContext(
+            release_type = 'final',
+            cargo_file = 'Cargo.toml',
+            version_file = 'src/version.txt',
+            readme_file = 'README.md',
+            disable_checks = False,
+            dry_run = False,
+            update_occurrences = True
+        )
+        crate = release.Crate('vors', 'Cargo.toml', 'src/version.txt', 'README.md')
+        release.update_crates_version_in_files(release_context, [(crate, semantic_version.Version('1.0.0'))])
+
+        assert tmpdir.join('Dockerfile').read() == 'FROM rust\nENV VORS_VERSION=1.0.0\nENV OTHER=1.0.0-SNAPSHOT\n'
+        assert tmpdir.join('docs', 'install.md').read() == 'Add vors-derive 1.0.0-SNAPSHOT.\nAdd vors 1.0.0.\n'
+        assert tmpdir.join('logo.png').read() == '\0vors 1.0.0-SNAPSHOT\n'
+
+        tmpdir.join('docs', 'install.md').write('vors = 1.0.0\n')
+        with mock.patch('release.scan_version_file', side_effect=release.scan_version_file) as scan_version_file:
+            index = release_context.version_occurrence_index(['vors'])
+        assert [args[0][0] for args, _ in scan_version_file.call_args_list] == [str(tmpdir.join('docs', 'install.md'))]
+        assert sorted(index.sites('vors', '1.0.0')) == ['Dockerfile', 'README.md', 'docs/install.md']
+
+def test_overlapped_build_builds_the_release_commit_while_the_next_version_is_committed(tmpdir, monkeypatch):
+    repo = init_release_repo(tmpdir)
+    monkeypatch.setattr(release, 'BUILD_CMD', write_fake_build(tmpdir, '\n'.join([
+        'import os',
+        'with open("src/version.txt") as version_file, open({!r}, "w") as built:'.format(str(tmpdir.join('built'))),
+        '    built.write(version_file.read() + " " + os.environ["CARGO_TARGET_DIR"])',
+    ])))
+    def new_release_context():
+        return release.ReleaseContext(
+            release_type = 'final',
+            cargo_file = 'Cargo.toml',
+            version_file = 'src/version.txt',
+            readme_file = 'README.md',
+            disable_checks = False,
+            dry_run = False,
+            version = '1.1.0',
+            overlap_build = True
+        )
+
+    with tmpdir.join('work').as_cwd():
+        assert release.run_release(new_release_context()) == ['v1.1.0']
+
+    assert tmpdir.join('built').read() == '1.1.0 {}'.format(tmpdir.join('work', 'target'))
+    assert repo.heads.master.commit == repo.tags['v1.1.0'].commit
+    assert repo.heads.develop.commit.parents[0] == repo.tags['v1.1.0'].commit
+    assert repo.git.show('develop:src/version.txt') == '1.1.1-SNAPSHOT'
+    assert not repo.is_dirty()
+    assert len(repo.git.worktree('list').splitlines()) == 1
+
+    original_head = repo.head.commit
+    monkeypatch.setattr(release, 'BUILD_CMD', 'false')
+    with tmpdir.join('work').as_cwd():
+        release_context = new_release_context()
+        release_context.version = '1.2.0'
+        with pytest.raises(SystemExit):
+            release.run_release(release_context)
+
+    assert repo.head.commit == original_head
+    assert not repo.is_dirty()
+    assert 'v1.2.0' not in [t.name for t in repo.tags]
+    assert not tmpdir.join('work', '.git', release.RELEASE_JOURNAL_FILE).check()
+    assert len(repo.git.worktree('list').splitlines()) == 1
+
+def test_stage_graph_runs_ready_stages_together_and_cancels_them_on_a_failure():
+    events = []
+    cancelled = threading.Event()
+    def slow():
+        events.append('slow started')
+        cancelled.wait(10)
+        return (1, 'Cancelled.')
+    def failing():
+        events.append('failing started')
+        return (1, 'error')
+    graph = release.StageGraph(2)
+    graph.add('slow', slow, cancelled.set)
+    graph.add('failing', failing)
+    graph.add('after', lambda: (0, None), depends_on=['failing'])
+
+    results, first_failure = graph.run()
+
+    assert first_failure == 'failing'
+    assert sorted(events) == ['failing started', 'slow started']
+    assert cancelled.is_set()
+    assert dict(results) == {
+        'failing': (1, 'error'),
+        'slow': (1, 'Cancelled.'),
+        'after': (1, 'Skipped because failing failed.'),
+    }
+    with pytest.raises(ValueError):
+        graph.add('orphan', failing, depends_on=['missing'])
+
+def test_attempt_release_build_runs_the_checks_alongside_the_build(tmpdir, monkeypatch):
+    init_repo(tmpdir)
+    monkeypatch.setattr(release, 'BUILD_CMD', write_fake_build(tmpdir, 'import time\ntime.sleep(30)\n'))
+    monkeypatch.setitem(release.CHECK_CMDS, 'test', '{} -c "print \\"test failure\\"; raise SystemExit(1)"'.format(sys.executable))
+    with tmpdir.as_cwd():
+        release_context = release.ReleaseContext(
+            release_type = 'final',
+            cargo_file = 'Cargo.toml',
+            version_file = 'src/version.txt',
+            readme_file = 'README.md',
+            disable_checks = False,
+            dry_run = False,
+            repo_dir = str(tmpdir),
+            checks = ['test']
+        )
+        start = release.monotonic_time()
+        build_result, error = release.attempt_release_build(release_context)
+
+    assert release.monotonic_time() - start < 10
+    assert build_result == 1
+    assert error.startswith('test failed. See {}.'.format(tmpdir.join('target', 'vors-checks', 'test.log')))
+    assert tmpdir.join('target', 'vors-checks', 'test.log').read() == 'test failure\n'
+    assert release.build_command('cargo clippy --release -- -D warnings') == [
+        'cargo', 'clippy', '--release', release.CARGO_MESSAGE_FORMAT, '--', '-D', 'warnings'
+    ]
+    assert release.build_command('cargo package --no-verify') == ['cargo', 'package', '--no-verify']
+
+def test_version_columns_match_the_single_version_functions():
+    version_strings = [
+        '1.0.0', '1.2.3-SNAPSHOT', '0.4.9-snapshot.2', '2.0.0-alpha+build.07',
+        '1.0', '01.0.0', '1.0.0-01', '1.0.0-', '1.0.0+', '1.0.0-a..b', 'x.y.z', '3.1.4-SNAPSHOT+001'
+    ]
+    now = datetime.datetime(2020, 1, 2, 3, 4, 5)
+    columns = release.VersionColumns.from_strings(version_strings)
+    versions = [
+        semantic_version.Version(version_string) if semantic_version.validate(version_string) else None
+        for version_string in version_strings
+    ]
+    assert [v is not None for v in columns.to_versions()] == [v is not None for v in versions]
+    assert columns.to_versions() == versions
+
+    transitions = [
+        (lambda c: c.to_snapshot(), release.to_snapshot_version),
+        (lambda c: c.to_next_patch_snapshot(), release.to_next_patch_snapshot_version),
+        (lambda c: c.to_snapshot_release(now), lambda v: release.to_snapshot_release_version(v, now)),
+        (lambda c: c.to_test_final_release(), release.to_test_final_release_version),
+        (lambda c: c.to_final_release(), release.to_final_release_version),
+    ]
+    for to_columns, to_version in transitions:
+        assert to_columns(columns).to_versions() == [to_version(v) if v else None for v in versions]
+
+    for release_type in ['snapshot', 'testfinal', 'final']:
+        release_context = release.ReleaseContext(
+            release_type = release_type,
+            cargo_file = 'Cargo.toml',
+            version_file = 'version.txt',
+            readme_file = 'README.md',
+            disable_checks = False,
+            dry_run = False
+        )
+        assert list(columns.valid_proposed(release_type)) == [
+            1 if release.is_valid_proposed_version(release_context, version_string) else 0
+            for version_string in version_strings
+        ]
+
+    assert release.VersionColumns.from_versions(v for v in versions if v).to_strings() == [
+        str(v) for v in versions if v
+    ]